@@ -19,6 +19,7 @@ import pyeo.core as pyeo
 import configparser
 import argparse
 import os
+import shutil
 import datetime as dt
 
 
@@ -43,6 +44,9 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--classify', dest='do_classify', action='store_true', default=False)
     parser.add_argument('-u', '--update', dest='do_update', action='store_true', default=False)
     parser.add_argument('-r', '--remove', dest='do_delete', action='store_true', default=False)
+    parser.add_argument('--virtual_stack', dest='virtual_stack', action='store_true', default=False,
+                        help="Stack images as .vrt files that read from the composite and image instead of "
+                             "writing new .tif stacks.")
 
     args = parser.parse_args()
 
@@ -105,7 +109,7 @@ if __name__ == "__main__":
         log.info("Aggregating composite layers")
         pyeo.aggregate_and_mask_10m_bands(composite_l2_image_dir, composite_merged_dir, cloud_certainty_threshold)
         log.info("Building initial cloud-free composite")
-        pyeo.composite_directory(composite_merged_dir, composite_dir)
+        pyeo.composite_directory(composite_merged_dir, composite_dir, provenance=True)
 
     # Query and download all images since last composite
     if args.do_download or do_all:
@@ -147,20 +151,45 @@ if __name__ == "__main__":
         # Stack with composite
         if args.do_stack or do_all:
             log.info("Stacking images with composite")
-            new_stack_path = pyeo.stack_old_and_new_images(latest_composite_path, new_image_path, stacked_image_dir)
+            new_stack_path = pyeo.stack_old_and_new_images(latest_composite_path, new_image_path, stacked_image_dir,
+                                                           virtual=args.virtual_stack)
 
         # Classify with composite
         if args.do_classify or do_all:
             log.info("Classifying with composite")
-            new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(os.path.basename(new_stack_path)))
-            new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(os.path.basename(new_stack_path)))
-            pyeo.classify_image(new_stack_path, model_path, new_class_image, new_prob_image, num_chunks=10)
+            new_stack_name = os.path.splitext(os.path.basename(new_stack_path))[0] + ".tif"
+            new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(new_stack_name))
+            new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(new_stack_name))
+            # Only classify the windows of the stack the new image has clear data in
+            new_mask_path = pyeo.get_mask_path(new_image_path)
+            if pyeo.get_valid_data_footprint(new_mask_path) is None:
+                log.warning("{} has no unmasked pixels, skipping classification".format(image))
+            else:
+                pyeo.classify_image(new_stack_path, model_path, new_class_image, new_prob_image,
+                                    footprint=new_mask_path)
 
         # Update composite
         if args.do_update or do_all:
             log.info("Updating composite")
             new_composite_path = os.path.join(composite_dir, "composite_"+os.path.basename(image))
-            pyeo.composite_images_with_mask((latest_composite_path, new_image_path), new_composite_path)
+            composite_files = (
+                (latest_composite_path, new_composite_path),
+                (pyeo.get_mask_path(latest_composite_path), pyeo.get_mask_path(new_composite_path)),
+                (pyeo.get_provenance_path(latest_composite_path), pyeo.get_provenance_path(new_composite_path)))
+            if args.virtual_stack:
+                # Virtual stacks read from the old composite, so it has to be left as it is; update a copy of it
+                # (and of its mask and provenance) named after the new image instead
+                for old_path, new_path in composite_files:
+                    if os.path.exists(old_path):
+                        shutil.copyfile(old_path, new_path)
+                pyeo.update_composite_with_image(new_composite_path, new_image_path)
+            else:
+                # Update the composite where the new image is clear, then rename it (and its mask and provenance)
+                # after the new image
+                pyeo.update_composite_with_image(latest_composite_path, new_image_path)
+                for old_path, new_path in composite_files:
+                    if os.path.exists(old_path):
+                        os.rename(old_path, new_path)
             latest_composite_path = new_composite_path
 
     log.info("***PROCESSING END***")
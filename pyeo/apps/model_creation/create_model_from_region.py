@@ -14,6 +14,10 @@ if __name__ == "__main__":
                         help="Attribute field holding the class to train on")
     parser.add_argument("out_path", type=str, action="store",
                         help="Path for the output .pkl file")
+    parser.add_argument("--features", nargs="*", default=None,
+                        help="Derived features to train on as well as the bands (ndvi, ndwi, band_diff)")
+    parser.add_argument("--bands_per_image", type=int, default=4,
+                        help="Number of bands of each image in the stacked rasters")
     args = parser.parse_args()
 
     conf = configparser.ConfigParser()
@@ -24,6 +28,7 @@ if __name__ == "__main__":
 
     pyeo.create_model_for_region(args.region_path, args.out_path,
                                  args.training_class.rsplit('.')[0]+"_scores.txt",
-                                 args.training_class)
+                                 args.training_class, feature_names=args.features,
+                                 bands_per_image=args.bands_per_image)
 
     log.info("***MODEL CREATION END***")
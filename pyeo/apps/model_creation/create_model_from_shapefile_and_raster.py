@@ -16,6 +16,9 @@ their class_id to 2.
 
 This code will create and store a pixel classifier from training data and rasters. Each pixel under a polygon
 provides a sample of that polygon's class, with every value of that pixel being a feature of that sample.
+Set derived_features to a space-separated list of ndvi, ndwi and band_diff to train on those as well; the model
+remembers them, and classify_image computes them for every pixel it classifies. If the raster has more than the
+four 10m bands per image, set bands_per_image to the number it has.
 
 At present, the model created is a balanced random forest classifier; there are plans to expand the function
 to take the model as an augment, but these are not yet implemented.
@@ -44,13 +47,18 @@ if __name__=="__main__":
     model_out_path = conf["pyeo"]["model"]
     class_field = conf["pyeo"]["class_field"]
     log_path = conf["pyeo"]["log_path"]
+    feature_names = conf["pyeo"].get("derived_features", "").split() or None
+    bands_per_image = conf["pyeo"].getint("bands_per_image", 4)
 
     log = pc.init_log(log_path)
 
     # This will be changed in the near future as I'm planning to refactor core soon
     #  to make the ML model building functions more granular
-    learning_data, classes = pc.get_training_data(training_raster_path, training_shape_path, class_field)
+    learning_data, classes = pc.get_training_data(training_raster_path, training_shape_path, class_field,
+                                                  feature_names=feature_names, bands_per_image=bands_per_image)
     model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
                                      min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
     model.fit(learning_data, classes)
+    model.pyeo_features = feature_names
+    model.pyeo_bands_per_image = bands_per_image
     joblib.dump(model, model_out_path)
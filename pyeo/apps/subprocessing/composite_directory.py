@@ -9,6 +9,9 @@
  the way through will be 0 at present (nodata to be implemented).
 
  Masks can either be single band images or n-band image (same at the corresponding .tif)
+
+ --method picks something other than the latest unmasked pixel: the per-band median or a percentile of every
+ unmasked observation, the observation with the highest NDVI, or the best-quality observation.
 """
 
 import sys, os
@@ -30,6 +33,16 @@ if __name__ == "__main__":
                         help="Path to logfile (optional)")
     parser.add_argument('-r', '--remask', dest='mask_path', action="store",
                         help="If present, remask the files using an image at model_path")
+    parser.add_argument('--method', dest='method', action="store", default="latest",
+                        choices=["latest", "median", "percentile", "max_ndvi", "best_pixel"],
+                        help="How to pick each pixel from its unmasked observations (default: latest)")
+    parser.add_argument('--percentile', dest='percentile', action="store", type=float, default=50,
+                        help="Percentile to take with --method percentile (default: 50)")
+    parser.add_argument('-j', '--n_jobs', dest='n_jobs', action="store", type=int, default=1,
+                        help="Number of processes to composite with; -1 for one per core (default: 1)")
+    parser.add_argument('-p', '--provenance', dest='provenance', action="store_true", default=False,
+                        help="Also write a .prov raster with the acquisition date and clear observation count of "
+                             "each pixel")
     args = parser.parse_args()
 
     comp_dir = args.in_dir
@@ -45,4 +58,5 @@ if __name__ == "__main__":
         for image in [os.path.join(os.path.dirname(comp_dir), file) for file in os.listdir(comp_dir)]:
             pyeo.core.create_mask_from_model(image, args.mask_path)
 
-    pyeo.core.composite_directory(comp_dir, args.out_path)
+    pyeo.core.composite_directory(comp_dir, args.out_path, method=args.method, percentile=args.percentile,
+                                  n_jobs=args.n_jobs, provenance=args.provenance)
@@ -9,7 +9,7 @@ from sentinelhub import download_safe_format
 from sentinelsat import SentinelAPI, geojson_to_wkt, read_geojson
 import subprocess
 import gdal
-from osgeo import ogr, osr
+from osgeo import ogr, osr, gdal_array
 import numpy as np
 import numpy.ma as ma
 from tempfile import TemporaryDirectory
@@ -18,6 +18,9 @@ from sklearn.model_selection import cross_val_score
 import scipy.sparse as sp
 import joblib
 import shutil
+import multiprocessing
+import collections
+import warnings
 
 import json
 import csv
@@ -441,10 +444,180 @@ def clean_aoi(aoi_dir, images_to_keep = 4, warning=True):
             os.remove(image.rsplit('.')(0)+".msk")
 
 
+# The layout every GeoTIFF written by pyeo is created with; see set_output_profile
+output_profile = {
+    "tiled": True,
+    "block_size": 256,
+    "compress": "DEFLATE",
+    "predictor": True,
+    "bigtiff": "IF_SAFER",
+    "overviews": False,
+    "overview_resampling": "NEAREST",
+    "cog": False
+}
+
+
+# The bit of each condition in a flags raster (see pack_mask_flags and get_mask_flags_path)
+mask_flags = {
+    "cloud": 1,
+    "shadow": 2,
+    "cirrus": 4,
+    "snow": 8,
+    "saturated": 16,
+    "nodata": 32
+}
+
+# The mask condition of each sen2cor scene classification (SCL) class; other classes are clear (see get_scl_lut)
+scl_mask_conditions = {
+    0: "nodata",
+    1: "saturated",
+    3: "shadow",
+    8: "cloud",
+    9: "cloud",
+    10: "cirrus",
+    11: "snow"
+}
+
+
+# The RasterIO resampling used by update_overview_windows for each overview_resampling in the output profile
+overview_resampling_algorithms = {
+    "NEAREST": gdal.GRIORA_NearestNeighbour,
+    "AVERAGE": gdal.GRIORA_Average,
+    "MODE": gdal.GRIORA_Mode,
+    "BILINEAR": gdal.GRIORA_Bilinear,
+    "CUBIC": gdal.GRIORA_Cubic,
+    "CUBICSPLINE": gdal.GRIORA_CubicSpline,
+    "LANCZOS": gdal.GRIORA_Lanczos,
+    "GAUSS": gdal.GRIORA_Gauss
+}
+
+
+def set_output_profile(**options):
+    """Sets how GeoTIFFs written by pyeo (stacks, mosaics, composites, masks, class and probability maps) are laid
+    out, for the rest of the session. Options are:
+    tiled: whether to write tiled (True) or striped (False) GeoTIFFs
+    block_size: width and height of each tile, a multiple of 16
+    compress: DEFLATE, ZSTD, LZW or NONE
+    predictor: whether to use a horizontal (integer) or floating point predictor to improve compression
+    bigtiff: YES, NO, IF_NEEDED or IF_SAFER
+    overviews: whether finished stacks, mosaics, composites and class maps get internal overviews
+    overview_resampling: the resampling method for overviews
+    cog: whether finished outputs are rewritten in cloud-optimised GeoTIFF layout (implies overviews)"""
+    for option in options:
+        if option not in output_profile:
+            raise ForestSentinelException("Unknown output profile option {}".format(option))
+    output_profile.update(options)
+
+
+def get_creation_options(format="GTiff", datatype=gdal.GDT_Int32, nbits=None):
+    """Returns the list of gdal creation options for a new raster of format and datatype in the output profile.
+    Only GeoTIFFs have creation options; other formats get an empty list. If nbits is given, each pixel is stored in
+    that many bits (NBITS) and no predictor is used, as GDAL only predicts whole bytes."""
+    if format != "GTiff":
+        return []
+    options = ["BIGTIFF={}".format(output_profile["bigtiff"])]
+    if nbits:
+        options.append("NBITS={}".format(nbits))
+    if output_profile["tiled"]:
+        options += ["TILED=YES",
+                    "BLOCKXSIZE={}".format(output_profile["block_size"]),
+                    "BLOCKYSIZE={}".format(output_profile["block_size"])]
+    if output_profile["compress"] not in (None, "NONE"):
+        options.append("COMPRESS={}".format(output_profile["compress"]))
+        if output_profile["predictor"] and not nbits:
+            is_float = datatype in (gdal.GDT_Float32, gdal.GDT_Float64)
+            options.append("PREDICTOR={}".format(3 if is_float else 2))
+    return options
+
+
+def finalise_output(raster_path, windows=None):
+    """Adds overviews to the closed GeoTIFF at raster_path and rewrites it in cloud-optimised layout, if the output
+    profile asks for them. Does nothing otherwise.
+    windows, if given, is a list of the (x_offset, y_offset, x_size, y_size) windows of a raster that has been
+    updated in place. If the raster already has overviews, only the overview pixels covering those windows are
+    regenerated (see update_overview_windows) and the raster is not rewritten, so the cost scales with the windows
+    rather than the raster. GDAL appends rewritten tiles to the end of the file, so an output updated this way is
+    no longer strictly cloud-optimised; call finalise_output again without windows to restore that layout."""
+    if not (output_profile["overviews"] or output_profile["cog"]) or not os.path.exists(raster_path):
+        return raster_path
+    log = logging.getLogger(__name__)
+    raster = gdal.Open(raster_path, gdal.GA_Update)
+    if raster.GetDriver().ShortName != "GTiff":
+        raster = None
+        return raster_path
+    if windows is not None and raster.GetRasterBand(1).GetOverviewCount() > 0:
+        log.info("Updating overviews of {} windows of {}".format(len(windows), raster_path))
+        update_overview_windows(raster, windows)
+        raster = None
+        return raster_path
+    datatype = raster.GetRasterBand(1).DataType
+    levels = []
+    level = 2
+    while min(raster.RasterXSize, raster.RasterYSize) // level >= output_profile["block_size"]:
+        levels.append(level)
+        level *= 2
+    log.info("Building overviews {} for {}".format(levels, raster_path))
+    raster.BuildOverviews(output_profile["overview_resampling"], levels or [2])
+    raster = None
+    if output_profile["cog"]:
+        # A tiled copy made with COPY_SRC_OVERVIEWS puts the overviews before the full-resolution tiles, which is
+        # the cloud-optimised layout
+        with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(raster_path))) as td:
+            cog_path = os.path.join(td, "cog.tif")
+            options = [option for option in get_creation_options("GTiff", datatype) if option != "TILED=YES"]
+            gdal.Translate(cog_path, raster_path,
+                           creationOptions=options + ["TILED=YES", "COPY_SRC_OVERVIEWS=YES"])
+            shutil.move(cog_path, raster_path)
+    return raster_path
+
+
+def update_overview_windows(raster, windows):
+    """Regenerates the pixels of every overview of raster that cover any of a list of (x_offset, y_offset, x_size,
+    y_size) windows of it, from each window widened to whole overview pixels. NEAREST overviews pick the same source
+    pixels as BuildOverviews; other overview_resampling methods are read through GDAL's resampling, which can differ
+    from BuildOverviews in the last digit or, at the edges of rasters whose size is not a multiple of the overview
+    factor, by a source pixel."""
+    resampling_name = output_profile["overview_resampling"].upper()
+    resampling = overview_resampling_algorithms.get(resampling_name, gdal.GRIORA_NearestNeighbour)
+    for band_index in range(1, raster.RasterCount + 1):
+        band = raster.GetRasterBand(band_index)
+        for overview_index in range(band.GetOverviewCount()):
+            overview = band.GetOverview(overview_index)
+            x_scale = raster.RasterXSize / overview.XSize
+            y_scale = raster.RasterYSize / overview.YSize
+            for x_off, y_off, x_size, y_size in windows:
+                overview_x = int(x_off // x_scale)
+                overview_y = int(y_off // y_scale)
+                overview_x_end = min(overview.XSize, int(np.ceil((x_off + x_size) / x_scale)))
+                overview_y_end = min(overview.YSize, int(np.ceil((y_off + y_size) / y_scale)))
+                if resampling_name == "NEAREST":
+                    # BuildOverviews takes source pixel int(0.5 + overview pixel * scale)
+                    columns = (0.5 + np.arange(overview_x, overview_x_end) * x_scale).astype(int)
+                    rows = (0.5 + np.arange(overview_y, overview_y_end) * y_scale).astype(int)
+                    columns = np.minimum(columns, raster.RasterXSize - 1)
+                    rows = np.minimum(rows, raster.RasterYSize - 1)
+                    in_x, in_y = columns[0], rows[0]
+                    data = band.ReadAsArray(int(in_x), int(in_y), int(columns[-1] - in_x + 1),
+                                            int(rows[-1] - in_y + 1))
+                    data = data[np.ix_(rows - in_y, columns - in_x)]
+                else:
+                    in_x = int(round(overview_x * x_scale))
+                    in_y = int(round(overview_y * y_scale))
+                    in_x_end = min(raster.RasterXSize, int(round(overview_x_end * x_scale)))
+                    in_y_end = min(raster.RasterYSize, int(round(overview_y_end * y_scale)))
+                    data = band.ReadAsArray(in_x, in_y, in_x_end - in_x, in_y_end - in_y,
+                                            buf_xsize=overview_x_end - overview_x,
+                                            buf_ysize=overview_y_end - overview_y, resample_alg=resampling)
+                overview.WriteArray(data, overview_x, overview_y)
+            overview = None
+        band = None
+
+
 def create_matching_dataset(in_dataset, out_path,
-                            format="GTiff", bands=1, datatype = None):
+                            format="GTiff", bands=1, datatype = None, nbits = None):
     """Creates an empty gdal dataset with the same dimensions, projection and geotransform. Defaults to 1 band.
-    Datatype is set from the first layer of in_dataset if unspecified"""
+    Datatype is set from the first layer of in_dataset if unspecified. GeoTIFFs are laid out as in the output
+    profile; see set_output_profile. nbits packs each pixel of a GeoTIFF into that many bits."""
     driver = gdal.GetDriverByName(format)
     if datatype is None:
         datatype = in_dataset.GetRasterBand(1).DataType
@@ -452,7 +625,8 @@ def create_matching_dataset(in_dataset, out_path,
                                 xsize=in_dataset.RasterXSize,
                                 ysize=in_dataset.RasterYSize,
                                 bands=bands,
-                                eType=datatype)
+                                eType=datatype,
+                                options=get_creation_options(format, datatype, nbits))
     out_dataset.SetGeoTransform(in_dataset.GetGeoTransform())
     out_dataset.SetProjection(in_dataset.GetProjection())
     return out_dataset
@@ -462,46 +636,96 @@ def create_new_stacks(image_dir, stack_dir, threshold = 100):
     """Creates new stacks with from the newest image. Threshold; how small a part
     of latest_image will be before it's considered to be fully processed
      New_image_name must exist inside image_dir.
-    TODO: Write up algorithm properly"""
-    # OK, here's the plan. Step 1: REMOVED. Not actually needed.
-    # Step 2: Sort directory by timestamp, *newest first*, discarding any newer
-    # than new_image_name
-    # Step 3: new_data_polygon = bounds(new_image_name)
-    # Step 4: for each image backwards in time:
-    #    a. Check if it intersects new_data_polygon
-    #    b. If it does
-    #       - add to a to_be_stacked list,
-    #       -subtract it's bounding box from new_data_polygon.
-    #   c. If new_data_polygon drops having a total area less than threshold, stop.
-    # Step 4: Stack new rasters for each image in new_data list.
+    Image bounds come from a footprint index cached in image_dir (see get_footprint_index), so only new or changed
+    images are opened, and the partners are chosen by select_stack_partners. Stacks that already exist in
+    stack_dir are skipped."""
+    # Step 1: Sort directory by timestamp, *newest first*
+    # Step 2: new_data_polygon = bounds(latest image)
+    # Step 3: for each image backwards in time, if it covers any of new_data_polygon that is not yet covered,
+    #   add it to to_be_stacked. Stop when less than threshold of new_data_polygon is uncovered.
+    # Step 4: Stack new rasters for each image in to_be_stacked.
     log = logging.getLogger(__name__)
     safe_files = glob.glob(os.path.join(image_dir, "*.tif"))
     if len(safe_files) == 0:
         raise CreateNewStacksException("image_dir is empty")
     safe_files = sort_by_s2_timestamp(safe_files)
     latest_image_path = safe_files[0]
-    latest_image = gdal.Open(latest_image_path)
-    new_data_poly = get_raster_bounds(latest_image)
-    to_be_stacked = []
-    for file in safe_files[1:]:
-        image = gdal.Open(file)
-        image_poly = get_raster_bounds(image)
-        if image_poly.Intersection(new_data_poly):
-            to_be_stacked.append(file)
-            new_data_poly = new_data_poly.Difference(image_poly)
-            if new_data_poly.GetArea() < threshold:
-                image = None
-                break
-        image = None
+    bounds = get_footprint_index(safe_files, os.path.join(image_dir, "footprint_index.json"))
+    to_be_stacked = [safe_files[index] for index in select_stack_partners(bounds, threshold)]
     new_images = []
     for image in to_be_stacked:
-        if image in os.listdir(stack_dir):
-            log.warning(r"{} exists, skipping.".format(image))
-            break
+        stack_path = get_stack_path(image, latest_image_path, stack_dir)
+        if os.path.exists(stack_path + ".tif") or os.path.exists(stack_path + ".vrt"):
+            log.warning(r"{} exists, skipping.".format(stack_path))
+            continue
         new_images.append(stack_old_and_new_images(image, latest_image_path, stack_dir))
     return new_images
 
 
+def get_footprint_index(image_paths, cache_path=None):
+    """Returns an [image, 4] array of the (x_min, x_max, y_min, y_max) bounds of each image in image_paths. If
+    cache_path is given, bounds are cached there as json keyed on each image's absolute path and modification
+    time, and only images that are new or have changed since the cache was written are opened."""
+    log = logging.getLogger(__name__)
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except ValueError:
+            log.warning("Footprint index {} is corrupt; rebuilding it".format(cache_path))
+    bounds = []
+    changed = False
+    for image_path in image_paths:
+        key = os.path.abspath(image_path)
+        mtime = os.path.getmtime(image_path)
+        entry = cache.get(key)
+        if entry is None or entry["mtime"] != mtime:
+            image = gdal.Open(image_path)
+            entry = {"mtime": mtime, "bounds": list(get_raster_bounds(image).GetEnvelope())}
+            image = None
+            cache[key] = entry
+            changed = True
+        bounds.append(entry["bounds"])
+    if cache_path and changed:
+        with open(cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+    return np.array(bounds, dtype=np.float64).reshape((-1, 4))
+
+
+def select_stack_partners(bounds, threshold=100):
+    """Given an [image, 4] array of (x_min, x_max, y_min, y_max) bounds, newest image first, returns the indices of
+    the older images to stack with the newest: each older image in turn is picked if it covers any part of the
+    newest image not already covered by a picked image, until less than threshold (in square map units) of the
+    newest image is uncovered."""
+    latest = bounds[0].astype(float)
+    if latest[1] <= latest[0] or latest[3] <= latest[2]:
+        return []
+    # The uncovered part of the newest image, as disjoint boxes. Each is made of cells of the grid of the picked
+    # images' edges, so with P images picked there are at most (2P+1)^2 of them, however many images are checked.
+    uncovered = latest[np.newaxis, :]
+    partners = []
+    for index, (x_min, x_max, y_min, y_max) in enumerate(bounds[1:], start=1):
+        overlaps = (uncovered[:, 0] < x_max) & (uncovered[:, 1] > x_min) & \
+                   (uncovered[:, 2] < y_max) & (uncovered[:, 3] > y_min)
+        if x_max <= x_min or y_max <= y_min or not overlaps.any():
+            continue
+        partners.append(index)
+        hit = uncovered[overlaps]
+        hit_x_min, hit_x_max, hit_y_min, hit_y_max = hit.T
+        mid_x_min = np.maximum(hit_x_min, x_min)
+        mid_x_max = np.minimum(hit_x_max, x_max)
+        # The parts of each overlapped box to the left and right of the image, then below and above it
+        left = np.column_stack((hit_x_min, mid_x_min, hit_y_min, hit_y_max))[hit_x_min < x_min]
+        right = np.column_stack((mid_x_max, hit_x_max, hit_y_min, hit_y_max))[hit_x_max > x_max]
+        below = np.column_stack((mid_x_min, mid_x_max, hit_y_min, np.minimum(hit_y_max, y_min)))[hit_y_min < y_min]
+        above = np.column_stack((mid_x_min, mid_x_max, np.maximum(hit_y_min, y_max), hit_y_max))[hit_y_max > y_max]
+        uncovered = np.concatenate((uncovered[~overlaps], left, right, below, above))
+        if np.sum((uncovered[:, 1] - uncovered[:, 0]) * (uncovered[:, 3] - uncovered[:, 2])) < threshold:
+            break
+    return partners
+
+
 def sort_by_s2_timestamp(strings, recent_first=True):
     """Takes a list of strings that contain sen2 timestamps and returns them sorted, most recent first. Does not
     guarantee ordering of strings with the same timestamp."""
@@ -533,9 +757,12 @@ def open_dataset_from_safe(safe_file_path, band, resolution = "10m"):
     return out
 
 
-def aggregate_and_mask_10m_bands(in_dir, out_dir, cloud_threshold = 60, cloud_model_path=None, force_reprocess=False):
+def aggregate_and_mask_10m_bands(in_dir, out_dir, cloud_threshold = 60, cloud_model_path=None, force_reprocess=False,
+                                 scene_classification=False):
     """For every folder in a directory, aggregates all 10m resolution bands into a single geotif
-     and create a cloudmask from the sen2cor confidence layer and RandomForest model if provided"""
+     and create a cloudmask from the sen2cor confidence layer and RandomForest model if provided. If
+     scene_classification is True and no model is given, the mask also uses the sen2cor scene classification layer
+     (see create_mask_from_scene_classification)."""
     log = logging.getLogger(__name__)
     safe_file_path_list = [os.path.join(in_dir, safe_file_path) for safe_file_path in os.listdir(in_dir)]
     for safe_dir in safe_file_path_list:
@@ -545,40 +772,53 @@ def aggregate_and_mask_10m_bands(in_dir, out_dir, cloud_threshold = 60, cloud_mo
             continue
         stack_sentinel_2_bands(safe_dir, out_path, band='10m')
         if cloud_model_path:
-            with TemporaryDirectory() as td:
-                temp_model_mask_path = os.path.join(td, "temp_model.msk")
-                confidence_mask_path = create_mask_from_confidence_layer(out_path, safe_dir, cloud_threshold)
-                create_mask_from_model(out_path, cloud_model_path, temp_model_mask_path)
-                combine_masks((temp_model_mask_path, confidence_mask_path), get_mask_path(out_path),
-                              combination_func="or")
+            create_mask_from_model_and_confidence_layer(out_path, safe_dir, cloud_model_path, cloud_threshold)
+        elif scene_classification:
+            create_mask_from_scene_classification(out_path, safe_dir, cloud_threshold)
         else:
             create_mask_from_confidence_layer(out_path, safe_dir, cloud_threshold)
 
 
-def stack_sentinel_2_bands(safe_dir, out_image_path, band = "10m"):
-    """Stacks the contents of a .SAFE granule directory into a single geotiff"""
+def stack_sentinel_2_bands(safe_dir, out_image_path, band = "10m", extra_20m_bands=None, resampling="nearest"):
+    """Stacks the contents of a .SAFE granule directory into a single geotiff. extra_20m_bands is an optional list of
+    20m bands (such as ["B05", "B06", "B07", "B8A", "B11", "B12"]) to add after the usual four; they are resampled
+    onto the grid of the first band with resampling as they are stacked. Models for stacks with extra bands must be
+    trained with bands_per_image set to match (see create_trained_model)."""
     granule_path = r"GRANULE/*/IMG_DATA/R{}/*_B0[8,4,3,2]_*.jp2".format(band)
     image_glob = os.path.join(safe_dir, granule_path)
     file_list = glob.glob(image_glob)
     file_list.sort()   # Sorting alphabetically gives the right order for bands
-    stack_images(file_list, out_image_path, geometry_mode="intersect")
+    for extra_band in extra_20m_bands or []:
+        extra_glob = os.path.join(safe_dir, r"GRANULE/*/IMG_DATA/R20m/*_{}_20m.jp2".format(extra_band))
+        file_list += glob.glob(extra_glob)
+    stack_images(file_list, out_image_path, geometry_mode="intersect", resampling=resampling)
     return out_image_path
 
 
-def stack_old_and_new_images(old_image_path, new_image_path, out_dir, create_combined_mask=True):
-    """Stacks an old and new image, names the result with the two timestamps"""
+def stack_old_and_new_images(old_image_path, new_image_path, out_dir, create_combined_mask=True, virtual=False):
+    """Stacks an old and new image, names the result with the two timestamps. If virtual is True, the stack is a
+    .vrt that reads from the two images (see stack_images_virtual) instead of a new .tif."""
     log = logging.getLogger(__name__)
     log.info("Stacking {} and {}".format(old_image_path, new_image_path))
-    old_timestamp = get_sen_2_image_timestamp(os.path.basename(old_image_path))
-    new_timestamp = get_sen_2_image_timestamp(os.path.basename(new_image_path))
-    out_path = os.path.join(out_dir, old_timestamp + '_' + new_timestamp)
-    stack_images([old_image_path, new_image_path], out_path + ".tif")
+    out_path = get_stack_path(old_image_path, new_image_path, out_dir)
+    if virtual:
+        out_image_path = stack_images_virtual([old_image_path, new_image_path], out_path + ".vrt")
+    else:
+        out_image_path = out_path + ".tif"
+        stack_images([old_image_path, new_image_path], out_image_path)
     if create_combined_mask:
         out_mask_path = out_path + ".msk"
         old_mask_path = get_mask_path(old_image_path)
         new_mask_path = get_mask_path(new_image_path)
         combine_masks([old_mask_path, new_mask_path], out_mask_path, combination_func="and", geometry_func="intersect")
-    return out_path + ".tif"
+    return out_image_path
+
+
+def get_stack_path(old_image_path, new_image_path, out_dir):
+    """Returns the path, without an extension, that stack_old_and_new_images gives the stack of two images"""
+    old_timestamp = get_sen_2_image_timestamp(os.path.basename(old_image_path))
+    new_timestamp = get_sen_2_image_timestamp(os.path.basename(new_image_path))
+    return os.path.join(out_dir, old_timestamp + '_' + new_timestamp)
 
 
 def get_sen_2_image_timestamp(image_name):
@@ -596,62 +836,133 @@ def get_pyeo_timestamp(image_name):
 
 
 def stack_images(raster_paths, out_raster_path,
-                 geometry_mode="intersect", format="GTiff", datatype=gdal.GDT_Int32):
+                 geometry_mode="intersect", format="GTiff", datatype=None, resolution=None, resampling="nearest"):
     """Stacks multiple images in image_paths together, using the information of the top image.
-    geometry_mode can be "union" or "intersect" """
+    geometry_mode can be "union" or "intersect". If datatype is unspecified, it is the narrowest type that holds
+    every input band (see get_common_datatype), so stacking uint16 images gives a uint16 stack.
+    The images do not have to share a resolution: the stack is on a grid of resolution (the top image's if not
+    given), and images on other grids are resampled with resampling as they are read (see stack_images_virtual),
+    without writing any resampled copies. The stack is copied from a temporary VRT one window at a time."""
     log = logging.getLogger(__name__)
     log.info("Stacking images {}".format(raster_paths))
     if len(raster_paths) <= 1:
         raise StackImagesException("stack_images requires at least two input images")
+    with TemporaryDirectory() as td:
+        vrt_path = stack_images_virtual(raster_paths, os.path.join(td, "stack.vrt"), geometry_mode, datatype,
+                                        resolution, resampling)
+        stack = gdal.Open(vrt_path)
+        out_raster = create_matching_dataset(stack, out_raster_path, format, bands=stack.RasterCount,
+                                             datatype=datatype)
+        item_size = gdal.GetDataTypeSize(stack.GetRasterBand(1).DataType) // 8
+        for window in plan_windows(out_raster, bytes_per_pixel=stack.RasterCount * item_size * 2):
+            x_off, y_off, x_size, y_size = window
+            write_window(out_raster, stack.ReadAsArray(*window).reshape((stack.RasterCount, y_size, x_size)),
+                         x_off, y_off)
+        out_raster = None
+        stack = None
+    finalise_output(out_raster_path)
+
+
+def stack_images_virtual(raster_paths, out_vrt_path, geometry_mode="intersect", datatype=None, resolution=None,
+                         resampling="nearest"):
+    """Stacks multiple images in raster_paths together as a VRT, using the information of the top image. Each
+    band of the VRT reads directly from its source image, so nothing but the small .vrt file is written; anything
+    that reads a stack made by stack_images (such as classify_image) can read this instead. The source images
+    must stay where they are for as long as the VRT is used. geometry_mode can be "union" or "intersect".
+    Datatype is set as in stack_images if unspecified. The VRT's pixels are resolution in size (the top image's if
+    not given); bands from images with a different resolution are resampled by GDAL with resampling (nearest,
+    bilinear, cubic, average...) whenever they are read. Returns out_vrt_path."""
+    log = logging.getLogger(__name__)
+    log.info("Virtually stacking images {}".format(raster_paths))
+    if len(raster_paths) <= 1:
+        raise StackImagesException("stack_images_virtual requires at least two input images")
     rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
-    total_layers = sum(raster.RasterCount for raster in rasters)
-    projection = rasters[0].GetProjection()
+    if datatype is None:
+        datatype = get_common_datatype(rasters)
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
-    y_res = in_gt[5]*-1   # Y resolution in agt is -ve for Maths reasons
+    y_res = in_gt[5]*-1
+    if resolution:
+        x_res, y_res = resolution, resolution
     combined_polygons = get_combined_polygon(rasters, geometry_mode)
-
-    # Creating a new gdal object
-    out_raster = create_new_image_from_polygon(combined_polygons, out_raster_path, x_res, y_res,
-                                               total_layers, projection, format, datatype)
-
-    # I've done some magic here. GetVirtualMemArray lets you change a raster directly without copying
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    present_layer = 0
-    for i, in_raster in enumerate(rasters):
-        log.info("Stacking image {}".format(i))
-        in_raster_array = in_raster.GetVirtualMemArray()
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, combined_polygons)
-        in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_raster, combined_polygons)
-        if len(in_raster_array.shape) == 2:
-            in_raster_array = np.expand_dims(in_raster_array, 0)
-        # Gdal does band, y, x
-        out_raster_view = out_raster_array[
-                      present_layer:  present_layer + in_raster.RasterCount,
-                      out_y_min: out_y_max,
-                      out_x_min: out_x_max
-                      ]
-        in_raster_view = in_raster_array[
-                    0:in_raster.RasterCount,
-                    in_y_min: in_y_max,
-                    in_x_min: in_x_max
-                    ]
-        np.copyto(out_raster_view, in_raster_view)
-        out_raster_view = None
-        in_raster_view = None
-        present_layer += in_raster.RasterCount
-    out_raster_array = None
+    out_raster = create_new_image_from_polygon(combined_polygons, out_vrt_path, x_res, y_res, 0,
+                                               rasters[0].GetProjection(), "VRT", datatype)
+    for raster_path, in_raster in zip(raster_paths, rasters):
+        source_window, dest_window = get_vrt_source_windows(in_raster, out_raster, combined_polygons)
+        for band_index in range(1, in_raster.RasterCount + 1):
+            out_raster.AddBand(datatype)
+            out_band = out_raster.GetRasterBand(out_raster.RasterCount)
+            out_band.SetMetadataItem("source_0", get_vrt_source_xml(
+                os.path.abspath(raster_path), band_index, source_window, dest_window, resampling),
+                "new_vrt_sources")
+            out_band = None
     out_raster = None
-
-
-def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.GDT_Int32, nodata = 0):
+    return out_vrt_path
+
+
+def get_vrt_source_windows(in_raster, out_raster, polygon):
+    """Returns (source_window, dest_window): the part of in_raster inside polygon as an (x_offset, y_offset, x_size,
+    y_size) window of out_raster, and the same area as a window of in_raster. The source window is fractional
+    where the two rasters' pixel grids do not line up, so that GDAL resamples exactly the right area."""
+    intersection = get_poly_intersection(get_raster_bounds(in_raster), polygon)
+    x_min, x_max, y_min, y_max = intersection.GetEnvelope()
+    in_gt = in_raster.GetGeoTransform()
+    out_gt = out_raster.GetGeoTransform()
+    dest_x_min = max(0, int(round((x_min - out_gt[0]) / out_gt[1])))
+    dest_x_max = min(out_raster.RasterXSize, int(round((x_max - out_gt[0]) / out_gt[1])))
+    dest_y_min = max(0, int(round((y_max - out_gt[3]) / out_gt[5])))  # y resolution is -ve
+    dest_y_max = min(out_raster.RasterYSize, int(round((y_min - out_gt[3]) / out_gt[5])))
+    dest_window = (dest_x_min, dest_y_min, dest_x_max - dest_x_min, dest_y_max - dest_y_min)
+    # Map the destination window back onto in_raster's grid
+    x_scale = out_gt[1] / in_gt[1]
+    y_scale = out_gt[5] / in_gt[5]
+    source_window = ((out_gt[0] + dest_x_min * out_gt[1] - in_gt[0]) / in_gt[1],
+                     (out_gt[3] + dest_y_min * out_gt[5] - in_gt[3]) / in_gt[5],
+                     dest_window[2] * x_scale,
+                     dest_window[3] * y_scale)
+    return source_window, dest_window
+
+
+def get_vrt_source_xml(source_path, source_band, source_window, dest_window, resampling="nearest"):
+    """Returns the XML of a VRT SimpleSource that copies the (x_offset, y_offset, x_size, y_size) source_window of
+    band source_band of source_path into dest_window of a VRT band, resampling with resampling if their sizes
+    differ"""
+    return ('<SimpleSource resampling="{}">'
+            '<SourceFilename relativeToVRT="0">{}</SourceFilename>'
+            '<SourceBand>{}</SourceBand>'
+            '<SrcRect xOff="{}" yOff="{}" xSize="{}" ySize="{}"/>'
+            '<DstRect xOff="{}" yOff="{}" xSize="{}" ySize="{}"/>'
+            '</SimpleSource>').format(resampling, source_path, source_band,
+                                      *(tuple(source_window) + tuple(dest_window)))
+
+
+def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=None, nodata = 0, n_jobs=1,
+                  mem_limit=None, priority="order", prob_paths=None):
     """Mosaics multiple images with the same number of layers into one single image. Overwrites
     overlapping pixels with the value furthest down raster_paths. Takes projection ect from the first
-    raster."""
+    raster. Datatype is set as in stack_images if unspecified; nodata must fit in it, and pixels equal to nodata
+    never overwrite anything. Uses at most mem_limit bytes, on n_jobs processes (-1 for all cores).
+    priority decides which raster wins where several have data:
+    order: the one furthest down raster_paths
+    latest: the one with the latest S2 timestamp in its name
+    confidence: the one with the highest probability in its probability raster; prob_paths must give the
+    probability raster (see classify_image) for each of raster_paths"""
     # This, again, is very similar to stack_rasters
     log = logging.getLogger(__name__)
     log.info("Beginning mosaic")
+    if priority == "latest":
+        raster_paths = sort_by_s2_timestamp(list(raster_paths), recent_first=False)
+    elif priority == "confidence":
+        if not prob_paths or len(prob_paths) != len(raster_paths):
+            raise ForestSentinelException("Mosaicking by confidence needs a probability raster for every raster")
+    elif priority != "order":
+        raise ForestSentinelException("Unknown mosaic priority {}".format(priority))
+    if priority != "confidence":
+        prob_paths = None
     rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    if datatype is None:
+        datatype = get_common_datatype(rasters)
+    check_nodata_fits(nodata, datatype)
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
@@ -661,30 +972,167 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
     out_raster = create_new_image_from_polygon(combined_polyon, out_raster_file, x_res, y_res, layers,
                                                projection, format, datatype)
     log.info("New empty image created at {}".format(out_raster_file))
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    for i, raster in enumerate(rasters):
-        log.info("Now mosaicing raster no. {}".format(i))
-        in_raster_array = raster.GetVirtualMemArray()
-        if len(in_raster_array.shape) == 2:
-            in_raster_array = np.expand_dims(in_raster_array, 0)
-        in_bounds = get_raster_bounds(raster)
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, in_bounds)
-        out_raster_view = out_raster_array[:, out_y_min: out_y_max, out_x_min: out_x_max]
-        np.copyto(out_raster_view, in_raster_array, where=in_raster_array != nodata)
-        in_raster_array = None
-        out_raster_view = None
+    out_gt = out_raster.GetGeoTransform()
+    out_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(datatype)
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if not mem_limit:
+        mem_limit = get_available_memory()
+    bytes_per_pixel = layers * np.dtype(out_dtype).itemsize * 3 + 1
+    if prob_paths:
+        bytes_per_pixel += 4 * 3
+    windows = plan_windows(out_raster, mem_limit // n_jobs, bytes_per_pixel=bytes_per_pixel,
+                           min_windows=n_jobs*4 if n_jobs > 1 else 1)
+    # Work out once which rasters each window needs, so that only those are read for it
+    jobs = list(zip(windows, get_rasters_in_windows(out_gt, windows, rasters)))
+    rasters = None
+    log.info("Mosaicking {} windows of {} rasters".format(len(windows), len(raster_paths)))
+    window_args = (out_gt, layers, out_dtype, nodata)
+    if n_jobs == 1:
+        init_mosaic_worker(raster_paths, prob_paths, window_args)
+        for window, mosaic in map(mosaic_window_in_worker, jobs):
+            write_window(out_raster, mosaic, window[0], window[1])
+        mosaic_worker_state.clear()
+    else:
+        # Workers mosaic windows and this process writes them as they arrive
+        with multiprocessing.Pool(n_jobs, initializer=init_mosaic_worker,
+                                  initargs=(raster_paths, prob_paths, window_args)) as pool:
+            for window, mosaic in pool.imap_unordered(mosaic_window_in_worker, jobs):
+                write_window(out_raster, mosaic, window[0], window[1])
     log.info("Raster mosaicing done")
-    out_raster_array = None
+    out_raster = None
+    finalise_output(out_raster_file)
+
+
+def get_rasters_in_windows(out_gt, windows, rasters):
+    """Returns, for each (x_offset, y_offset, x_size, y_size) window of a raster with geotransform out_gt, the list
+    of indices of the rasters that overlap it. Works on the bounding boxes of every raster and window at once."""
+    windows = np.array(windows).reshape((-1, 4))
+    # Bounding box of each raster in the output's pixel coordinates
+    boxes = np.array([
+        (round((raster.GetGeoTransform()[0] - out_gt[0]) / out_gt[1]),
+         round((raster.GetGeoTransform()[3] - out_gt[3]) / out_gt[5]),
+         raster.RasterXSize, raster.RasterYSize)
+        for raster in rasters])
+    overlaps = (
+        (boxes[np.newaxis, :, 0] < (windows[:, 0] + windows[:, 2])[:, np.newaxis]) &
+        ((boxes[:, 0] + boxes[:, 2])[np.newaxis, :] > windows[:, np.newaxis, 0]) &
+        (boxes[np.newaxis, :, 1] < (windows[:, 1] + windows[:, 3])[:, np.newaxis]) &
+        ((boxes[:, 1] + boxes[:, 3])[np.newaxis, :] > windows[:, np.newaxis, 1])
+    )
+    return [np.flatnonzero(window_overlaps).tolist() for window_overlaps in overlaps]
+
+
+def mosaic_window(rasters, out_gt, window, layers, dtype, nodata=0, prob_rasters=None):
+    """Returns the [band, y, x] mosaic of an (x_offset, y_offset, x_size, y_size) window of an output raster with
+    geotransform out_gt from rasters, which should be the rasters that overlap it in priority order (lowest first).
+    Each raster's pixels that are not nodata overwrite what is there. If prob_rasters (the matching probability
+    rasters) is given, a pixel is only overwritten if the new raster is more confident there: if the highest of its
+    class probabilities is higher than that of the pixel already there."""
+    x_off, y_off, x_size, y_size = window
+    mosaic = np.full((layers, y_size, x_size), nodata, dtype=dtype)
+    best_confidence = None
+    if prob_rasters is not None:
+        best_confidence = np.full((y_size, x_size), -np.inf, dtype=np.float32)
+    for raster_index, raster in enumerate(rasters):
+        overlap = get_window_overlap(out_gt, window, raster)
+        if overlap is None:
+            continue
+        (out_x, out_y), in_window = overlap
+        in_x_size, in_y_size = in_window[2], in_window[3]
+        image_data = raster.ReadAsArray(*in_window).reshape((layers, in_y_size, in_x_size))
+        has_data = image_data != nodata
+        mosaic_view = mosaic[:, out_y: out_y + in_y_size, out_x: out_x + in_x_size]
+        if best_confidence is not None:
+            confidence = get_max_probability(prob_rasters[raster_index], in_window)
+            confidence_view = best_confidence[out_y: out_y + in_y_size, out_x: out_x + in_x_size]
+            more_confident = has_data.any(axis=0) & (confidence > confidence_view)
+            has_data &= more_confident
+            confidence_view[more_confident] = confidence[more_confident]
+        np.copyto(mosaic_view, image_data, where=has_data)
+    return mosaic
+
+
+def get_max_probability(prob_raster, window):
+    """Returns the highest class probability of each pixel in an (x_offset, y_offset, x_size, y_size) window of a
+    probability raster, as float32, undoing any scaling from quantize_probs"""
+    x_off, y_off, x_size, y_size = window
+    probs = prob_raster.ReadAsArray(*window).reshape((prob_raster.RasterCount, y_size, x_size))
+    band = prob_raster.GetRasterBand(1)
+    scale = band.GetScale() or 1
+    offset = band.GetOffset() or 0
+    band = None
+    return probs.max(axis=0).astype(np.float32) * scale + offset
+
+
+# Per-process state for mosaic_images' workers; filled in by init_mosaic_worker
+mosaic_worker_state = {}
+
+
+def init_mosaic_worker(raster_paths, prob_paths, window_args):
+    """Opens every raster (and probability raster) once per mosaic_images worker process"""
+    mosaic_worker_state["rasters"] = [gdal.Open(path) for path in raster_paths]
+    mosaic_worker_state["prob_rasters"] = [gdal.Open(path) for path in prob_paths] if prob_paths else None
+    mosaic_worker_state["window_args"] = window_args
+
+
+def mosaic_window_in_worker(job):
+    """Mosaics a (window, raster_indices) job with the worker's rasters. Returns (window, mosaic)."""
+    window, raster_indices = job
+    state = mosaic_worker_state
+    out_gt, layers, dtype, nodata = state["window_args"]
+    rasters = [state["rasters"][index] for index in raster_indices]
+    prob_rasters = None
+    if state["prob_rasters"] is not None:
+        prob_rasters = [state["prob_rasters"][index] for index in raster_indices]
+    return window, mosaic_window(rasters, out_gt, window, layers, dtype, nodata, prob_rasters)
+
+
+def get_common_datatype(rasters):
+    """Returns the narrowest gdal datatype that can hold every value of every band of every raster in rasters; for
+    example, UInt16 for Sentinel-2 images, Int32 for a UInt16 and an Int16 image. Falls back to Float64 if there
+    is no such integer type in gdal."""
+    numpy_types = [gdal_array.GDALTypeCodeToNumericTypeCode(raster.GetRasterBand(band_index + 1).DataType)
+                   for raster in rasters for band_index in range(raster.RasterCount)]
+    datatype = gdal_array.NumericTypeCodeToGDALTypeCode(np.result_type(*numpy_types).type)
+    if datatype is None:
+        datatype = gdal.GDT_Float64
+    return datatype
+
+
+def check_nodata_fits(nodata, datatype):
+    """Raises a ForestSentinelException if nodata cannot be stored exactly in a raster of gdal datatype"""
+    if nodata is None:
+        return
+    numpy_type = gdal_array.GDALTypeCodeToNumericTypeCode(datatype)
+    if np.issubdtype(numpy_type, np.integer):
+        type_info = np.iinfo(numpy_type)
+        if nodata != int(nodata) or not type_info.min <= nodata <= type_info.max:
+            raise ForestSentinelException("Nodata value {} does not fit in a {} raster"
+                                          .format(nodata, gdal.GetDataTypeName(datatype)))
 
 
-def composite_images_with_mask(in_raster_path_list, composite_out_path, format="GTiff"):
+def composite_images_with_mask(in_raster_path_list, composite_out_path, format="GTiff", n_jobs=1, mem_limit=None,
+                               method="latest", percentile=50, provenance=False):
     """Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Masks are assumed to
     be a binary .msk file with the same path as their corresponding image. All images must have the same
     number of layers and resolution, but do not have to be perfectly on top of each other. If it does not exist,
-    composite_out_path will be created. Takes projection, resolution, ect from first band of first raster in list."""
+    composite_out_path will be created. Takes projection, resolution, ect from first band of first raster in list.
+    Uses at most mem_limit bytes (80% of available memory if not given), on n_jobs processes (-1 for all cores).
+    method chooses how each pixel is picked from its unmasked observations:
+    latest: the last one in in_raster_path_list
+    median: the per-band median
+    percentile: the per-band percentile given by percentile (0 to 100)
+    max_ndvi: the observation with the highest NDVI
+    best_pixel: the observation with the best quality score (see get_composite_scores)
+    If provenance is True, a provenance raster (see get_provenance_path) is written alongside the composite, holding
+    the acquisition date of each pixel and how many clear observations it had; every image name must then contain
+    an S2 timestamp. update_composite_with_image keeps it up to date."""
 
     log = logging.getLogger(__name__)
-    driver = gdal.GetDriverByName(format)
+    if method not in ("latest", "median", "percentile", "max_ndvi", "best_pixel"):
+        raise ForestSentinelException("Unknown composite method {}".format(method))
     in_raster_list = [gdal.Open(raster) for raster in in_raster_path_list]
     projection = in_raster_list[0].GetProjection()
     in_gt = in_raster_list[0].GetGeoTransform()
@@ -695,47 +1143,363 @@ def composite_images_with_mask(in_raster_path_list, composite_out_path, format="
     datatype = temp_band.DataType
     temp_band = None
 
-    # Creating output image + array
+    # Creating output image
     log.info("Creating composite at {}".format(composite_out_path))
     log.info("Composite info: x_res: {}, y_res: {}, {} bands, datatype: {}, projection: {}"
              .format(x_res, y_res, n_bands, datatype, projection))
     out_bounds = get_combined_polygon(in_raster_list, geometry_mode="union")
+    in_raster_list = None
     composite_image = create_new_image_from_polygon(out_bounds, composite_out_path, x_res, y_res, n_bands,
                                                     projection, format, datatype)
-    output_array = composite_image.GetVirtualMemArray(eAccess=gdal.gdalconst.GF_Write)
-    if len(output_array.shape) == 2:
-        output_array = np.expand_dims(output_array, 0)
-
-    mask_paths = []
-
-    for i, in_raster in enumerate(in_raster_list):
-        # Get a view of in_raster according to output_array
-        log.info("Adding {} to composite".format(in_raster_path_list[i]))
-        in_bounds = get_raster_bounds(in_raster)
-        x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(composite_image, in_bounds)
-        output_view = output_array[:, y_min:y_max, x_min:x_max]
-
-        # Move every unmasked pixel in in_raster to output_view
-        mask_paths.append(get_mask_path(in_raster_path_list[i]))
-        log.info("Mask for {} at {}".format(in_raster_path_list[i], mask_paths[i]))
-        in_masked = get_masked_array(in_raster, mask_paths[i])
-        np.copyto(output_view, in_masked, where=np.logical_not(in_masked.mask))
-
-        # Deallocate
-        output_view = None
-        in_masked = None
-
-    output_array = None
-    output_image = None
+    out_gt = composite_image.GetGeoTransform()
+    out_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(datatype)
+    mask_paths = [get_mask_path(raster_path) for raster_path in in_raster_path_list]
+    for raster_path, mask_path in zip(in_raster_path_list, mask_paths):
+        log.info("Adding {} to composite with mask {}".format(raster_path, mask_path))
+    image_days = None
+    provenance_image = None
+    if provenance:
+        image_days = [get_days_since_epoch(get_s2_image_acquisition_time(raster_path))
+                      for raster_path in in_raster_path_list]
+        provenance_path = get_provenance_path(composite_out_path)
+        log.info("Recording provenance in {}".format(provenance_path))
+        provenance_image = create_matching_dataset(composite_image, provenance_path, bands=2,
+                                                   datatype=gdal.GDT_UInt16)
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if not mem_limit:
+        mem_limit = get_available_memory()
+    bytes_per_pixel = n_bands * np.dtype(out_dtype).itemsize * 3 + 1
+    if method != "latest":
+        # Every method but latest needs a float32 time stack of every image, plus the copy that the median and
+        # percentile sort, so its windows are smaller
+        bytes_per_pixel += len(in_raster_path_list) * n_bands * 4 * 2
+    # Each window reads only the parts of each image and mask that overlap it (see composite_window)
+    windows = plan_windows(composite_image, mem_limit // n_jobs, bytes_per_pixel=bytes_per_pixel,
+                           min_windows=n_jobs*4 if n_jobs > 1 else 1)
+    log.info("Compositing {} windows".format(len(windows)))
+    if n_jobs == 1:
+        rasters, masks = open_images_and_masks(in_raster_path_list, mask_paths)
+        for window in windows:
+            composite, window_provenance = composite_window(rasters, masks, out_gt, window, n_bands, out_dtype,
+                                                            method, percentile, image_days)
+            write_window(composite_image, composite, window[0], window[1])
+            if provenance_image is not None:
+                write_window(provenance_image, window_provenance, window[0], window[1])
+        rasters = None
+        masks = None
+    else:
+        # Workers composite windows and this process writes them as they arrive
+        with multiprocessing.Pool(n_jobs, initializer=init_composite_worker,
+                                  initargs=(in_raster_path_list, mask_paths, out_gt, n_bands, out_dtype,
+                                            method, percentile, image_days)) as pool:
+            for window, composite, window_provenance in pool.imap_unordered(composite_window_in_worker, windows):
+                write_window(composite_image, composite, window[0], window[1])
+                if provenance_image is not None:
+                    write_window(provenance_image, window_provenance, window[0], window[1])
+
+    composite_image = None
+    provenance_image = None
+    finalise_output(composite_out_path)
     log.info("Composite done")
     log.info("Creating composite mask at {}".format(composite_out_path.rsplit(".")[0]+".msk"))
     combine_masks(mask_paths, composite_out_path.rsplit(".")[0]+".msk", combination_func='or', geometry_func="union")
     return composite_out_path
 
 
-def composite_directory(image_dir, composite_out_dir, format="GTiff"):
+def open_images_and_masks(image_paths, mask_paths):
+    """Returns lists of the opened images and masks"""
+    return [gdal.Open(path) for path in image_paths], [gdal.Open(path) for path in mask_paths]
+
+
+def composite_window(rasters, masks, out_gt, window, n_bands, dtype, method="latest", percentile=50,
+                     image_days=None):
+    """Returns the [band, y, x] composite of an (x_offset, y_offset, x_size, y_size) window of an output raster with
+    geotransform out_gt. Each raster in turn is read for just the part that overlaps the window, and its pixels
+    that are not masked (nonzero in the matching mask) overwrite what is there; later rasters win. Pixels that are
+    masked in every raster are 0. Masks can be single band or have as many bands as the rasters.
+    For methods other than latest, the unmasked pixels are instead gathered into a time stack (see
+    get_window_time_stack) and reduced with reduce_time_stack.
+    Returns (composite, provenance). If image_days (the acquisition date of each raster, in days since epoch) is
+    given, provenance is a uint16 [2, y, x] array of the date each pixel came from and its number of clear
+    observations, as in get_time_stack_provenance; otherwise it is None."""
+    if method != "latest":
+        stack, layer_indices = get_window_time_stack(rasters, masks, out_gt, window, n_bands)
+        provenance = None
+        if image_days is not None:
+            provenance = get_time_stack_provenance(stack, [image_days[index] for index in layer_indices], method)
+        return reduce_time_stack(stack, dtype, method, percentile), provenance
+    x_off, y_off, x_size, y_size = window
+    composite = np.zeros((n_bands, y_size, x_size), dtype=dtype)
+    provenance = None
+    if image_days is not None:
+        provenance = np.zeros((2, y_size, x_size), dtype=np.uint16)
+    for raster_index, (raster, mask) in enumerate(zip(rasters, masks)):
+        overlap = get_window_overlap(out_gt, window, raster)
+        if overlap is None:
+            continue
+        (out_x, out_y), in_window = overlap
+        in_x_size, in_y_size = in_window[2], in_window[3]
+        image_data = raster.ReadAsArray(*in_window).reshape((n_bands, in_y_size, in_x_size))
+        clear = read_mask_window(mask, in_window)
+        composite_view = composite[:, out_y: out_y + in_y_size, out_x: out_x + in_x_size]
+        np.copyto(composite_view, image_data, where=clear)
+        if provenance is not None:
+            pixel_clear = clear.any(axis=0)
+            provenance_view = provenance[:, out_y: out_y + in_y_size, out_x: out_x + in_x_size]
+            provenance_view[0][pixel_clear] = image_days[raster_index]
+            provenance_view[1] += pixel_clear
+    return composite, provenance
+
+
+def get_window_time_stack(rasters, masks, out_gt, window, n_bands):
+    """Returns a float32 [image, band, y, x] array of an (x_offset, y_offset, x_size, y_size) window of an output
+    raster with geotransform out_gt, with one layer for each raster that overlaps the window, and the list of the
+    indices in rasters of those layers. Pixels that are masked or outside a raster are NaN."""
+    x_off, y_off, x_size, y_size = window
+    overlaps = [(index, raster, mask, get_window_overlap(out_gt, window, raster))
+                for index, (raster, mask) in enumerate(zip(rasters, masks))]
+    overlaps = [overlap for overlap in overlaps if overlap[3] is not None]
+    stack = np.full((len(overlaps), n_bands, y_size, x_size), np.nan, dtype=np.float32)
+    for layer, (_, raster, mask, ((out_x, out_y), in_window)) in zip(stack, overlaps):
+        in_x_size, in_y_size = in_window[2], in_window[3]
+        image_data = raster.ReadAsArray(*in_window).reshape((n_bands, in_y_size, in_x_size))
+        clear = read_mask_window(mask, in_window)
+        np.copyto(layer[:, out_y: out_y + in_y_size, out_x: out_x + in_x_size], image_data, where=clear)
+    return stack, [overlap[0] for overlap in overlaps]
+
+
+def reduce_time_stack(stack, dtype, method="median", percentile=50):
+    """Reduces a float32 [image, band, y, x] time stack (NaN where masked) to a [band, y, x] composite of dtype by
+    method (median, percentile, max_ndvi or best_pixel; see composite_images_with_mask). Pixels with no unmasked
+    observations are 0. Integer outputs are rounded."""
+    n_bands, y_size, x_size = stack.shape[1:]
+    if stack.shape[0] == 0:
+        return np.zeros((n_bands, y_size, x_size), dtype=dtype)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # All-NaN pixels are expected and handled below
+        if method == "median":
+            composite = np.nanmedian(stack, axis=0)
+        elif method == "percentile":
+            composite = np.nanpercentile(stack, percentile, axis=0)
+        elif method in ("max_ndvi", "best_pixel"):
+            best = np.argmax(get_composite_scores(stack, method), axis=0)
+            composite = np.take_along_axis(stack, best[np.newaxis, np.newaxis, ...], axis=0)[0]
+        else:
+            raise ForestSentinelException("Unknown composite method {}".format(method))
+    composite = np.nan_to_num(composite, nan=0)
+    if np.issubdtype(dtype, np.integer):
+        composite = np.rint(composite)
+    return composite.astype(dtype)
+
+
+def get_time_stack_provenance(stack, layer_days, method="median"):
+    """Returns a uint16 [2, y, x] array for a float32 [image, band, y, x] time stack (NaN where masked) whose layers
+    were acquired on layer_days (days since epoch). The first band is the date the composite's pixel came from:
+    the chosen observation for max_ndvi and best_pixel, and the latest unmasked observation for the other methods,
+    which blend several. The second band is the number of unmasked observations. Both are 0 where there are none."""
+    n_layers, _, y_size, x_size = stack.shape
+    provenance = np.zeros((2, y_size, x_size), dtype=np.uint16)
+    if n_layers == 0:
+        return provenance
+    observed = ~np.isnan(stack).all(axis=1)
+    layer_days = np.asarray(layer_days, dtype=np.uint16)
+    if method in ("max_ndvi", "best_pixel"):
+        best = np.argmax(get_composite_scores(stack, method), axis=0)
+        provenance[0] = np.where(observed.any(axis=0), layer_days[best], 0)
+    else:
+        provenance[0] = np.where(observed, layer_days[:, np.newaxis, np.newaxis], 0).max(axis=0)
+    provenance[1] = observed.sum(axis=0)
+    return provenance
+
+
+def get_composite_scores(stack, method):
+    """Returns an [image, y, x] array scoring each observation in a float32 [image, band, y, x] time stack of
+    blue, green, red, NIR images; masked observations score -inf. For max_ndvi the score is NDVI. For best_pixel it
+    is the negated blue reflectance, which prefers the clearest observation: thin cloud, haze and cloud edges that
+    the masks miss are all bright in blue."""
+    if method == "max_ndvi":
+        red = stack[:, 2, ...]
+        nir = stack[:, 3, ...]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = (nir - red) / (nir + red)
+    elif method == "best_pixel":
+        scores = -stack[:, 0, ...]
+    else:
+        raise ForestSentinelException("Unknown scoring method {}".format(method))
+    scores[~np.isfinite(scores)] = -np.inf
+    return scores
+
+
+def get_window_overlap(out_gt, window, raster):
+    """Finds where raster overlaps an (x_offset, y_offset, x_size, y_size) window of a raster with geotransform
+    out_gt, assuming the two share a pixel grid. Returns ((x, y), in_window), where (x, y) is the position of the
+    overlap inside the window and in_window is the overlap as a window of raster, or None if they do not overlap."""
+    in_gt = raster.GetGeoTransform()
+    # Top-left corner of raster in the output's pixel coordinates
+    in_x = int(round((in_gt[0] - out_gt[0]) / out_gt[1]))
+    in_y = int(round((in_gt[3] - out_gt[3]) / out_gt[5]))
+    x_off, y_off, x_size, y_size = window
+    x_min = max(x_off, in_x)
+    x_max = min(x_off + x_size, in_x + raster.RasterXSize)
+    y_min = max(y_off, in_y)
+    y_max = min(y_off + y_size, in_y + raster.RasterYSize)
+    if x_min >= x_max or y_min >= y_max:
+        return None
+    return (x_min - x_off, y_min - y_off), (x_min - in_x, y_min - in_y, x_max - x_min, y_max - y_min)
+
+
+# Per-process state for composite_images_with_mask's workers; filled in by init_composite_worker
+composite_worker_state = {}
+
+
+def init_composite_worker(image_paths, mask_paths, out_gt, n_bands, dtype, method="latest", percentile=50,
+                          image_days=None):
+    """Opens every image and mask once per composite_images_with_mask worker process"""
+    rasters, masks = open_images_and_masks(image_paths, mask_paths)
+    composite_worker_state["rasters"] = rasters
+    composite_worker_state["masks"] = masks
+    composite_worker_state["window_args"] = (out_gt, n_bands, dtype, method, percentile, image_days)
+
+
+def composite_window_in_worker(window):
+    """Composites a window with the worker's images and masks. Returns (window, composite, provenance)."""
+    state = composite_worker_state
+    out_gt, n_bands, dtype, method, percentile, image_days = state["window_args"]
+    composite, provenance = composite_window(state["rasters"], state["masks"], out_gt, window, n_bands, dtype,
+                                             method, percentile, image_days)
+    return window, composite, provenance
+
+
+def update_composite_with_image(composite_path, image_path, record_provenance=True):
+    """Updates the composite at composite_path in place with the unmasked pixels of image_path, as if image_path had
+    been the last image given to composite_images_with_mask. Only the blocks of the composite that the image's
+    clear pixels fall in are read and rewritten, so the cost scales with the new image rather than the composite.
+    The composite's mask is updated to match. The image must be on the composite's pixel grid. If the image reaches
+    outside the composite, the composite is first grown to cover both (see grow_composite), which rewrites it once.
+    If record_provenance is True, the acquisition date of image_path is written to
+    the composite's provenance raster (see get_provenance_path) for every pixel it updates, and their count of clear
+    observations is incremented; the provenance raster is created if it does not exist. Returns composite_path."""
+    log = logging.getLogger(__name__)
+    log.info("Updating composite {} with {}".format(composite_path, image_path))
+    image_mask_path = get_mask_path(image_path)
+    footprint = get_valid_data_footprint(image_mask_path)
+    if footprint is None:
+        log.warning("{} has no unmasked pixels; composite not updated".format(image_path))
+        return composite_path
+    image = gdal.Open(image_path)
+    grow_composite(composite_path, image)
+    composite = gdal.Open(composite_path, gdal.GA_Update)
+    composite_mask = open_matching_dataset_for_update(composite, get_mask_path(composite_path))
+    image_mask = gdal.Open(image_mask_path)
+    provenance = None
+    if record_provenance:
+        provenance = open_provenance_dataset(composite, get_provenance_path(composite_path))
+        image_day = get_days_since_epoch(get_s2_image_acquisition_time(image_path))
+    composite_gt = composite.GetGeoTransform()
+    windows = get_windows_in_footprint(composite, get_block_windows(composite), footprint)
+    updated_windows = []
+    updated_pixels = 0
+    for window in windows:
+        overlap = get_window_overlap(composite_gt, window, image)
+        if overlap is None:
+            continue
+        (out_x, out_y), in_window = overlap
+        clear = read_mask_window(image_mask, in_window)
+        if not clear.any():
+            continue
+        x_size, y_size = in_window[2], in_window[3]
+        target_x, target_y = window[0] + out_x, window[1] + out_y
+        composite_data = composite.ReadAsArray(target_x, target_y, x_size, y_size)\
+            .reshape((composite.RasterCount, y_size, x_size))
+        image_data = image.ReadAsArray(*in_window).reshape((image.RasterCount, y_size, x_size))
+        np.copyto(composite_data, image_data, where=clear)
+        write_window(composite, composite_data, target_x, target_y)
+        # A pixel is clear in the composite's mask if it is clear in any band of the image's mask
+        pixel_clear = clear.any(axis=0)
+        mask_band = composite_mask.GetRasterBand(1)
+        mask_data = mask_band.ReadAsArray(target_x, target_y, x_size, y_size)
+        mask_data[pixel_clear] = 1
+        mask_band.WriteArray(mask_data, target_x, target_y)
+        mask_band = None
+        if provenance is not None:
+            provenance_data = provenance.ReadAsArray(target_x, target_y, x_size, y_size)
+            provenance_data[0][pixel_clear] = image_day
+            provenance_data[1] += pixel_clear
+            write_window(provenance, provenance_data, target_x, target_y)
+        updated_pixels += np.count_nonzero(pixel_clear)
+        updated_windows.append((target_x, target_y, x_size, y_size))
+    log.info("Updated {} pixels in {} windows of {}".format(updated_pixels, len(windows), composite_path))
+    composite = None
+    composite_mask = None
+    provenance = None
+    finalise_output(composite_path, updated_windows)
+    return composite_path
+
+
+def grow_composite(composite_path, raster):
+    """Enlarges the composite at composite_path in place, along with its mask and provenance raster if they exist, to
+    the union of its extent and that of raster, which must be on the composite's pixel grid. The new pixels are 0, so
+    are masked and have no provenance. Returns True if the composite was grown, or False if raster was already
+    inside it."""
+    log = logging.getLogger(__name__)
+    composite = gdal.Open(composite_path)
+    combined_polygon = get_combined_polygon([composite, raster], geometry_mode="union")
+    if combined_polygon.GetEnvelope() == get_raster_bounds(composite).GetEnvelope():
+        return False
+    log.info("Growing composite {} to the extent {}".format(composite_path, combined_polygon.GetEnvelope()))
+    gt = composite.GetGeoTransform()
+    composite = None
+    for path in (composite_path, get_mask_path(composite_path), get_provenance_path(composite_path)):
+        if not os.path.exists(path):
+            continue
+        old_raster = gdal.Open(path)
+        grown_path = path + ".grown"
+        # Keep 1-bit masks 1-bit
+        nbits = old_raster.GetRasterBand(1).GetMetadataItem("NBITS", "IMAGE_STRUCTURE")
+        grown_raster = create_new_image_from_polygon(combined_polygon, grown_path, gt[1], -gt[5],
+                                                     old_raster.RasterCount, old_raster.GetProjection(),
+                                                     datatype=old_raster.GetRasterBand(1).DataType, nodata=0,
+                                                     nbits=int(nbits) if nbits else None)
+        (x_off, y_off), _ = get_window_overlap(grown_raster.GetGeoTransform(),
+                                               (0, 0, grown_raster.RasterXSize, grown_raster.RasterYSize), old_raster)
+        for window in get_block_windows(old_raster):
+            data = old_raster.ReadAsArray(*window).reshape((old_raster.RasterCount, window[3], window[2]))
+            write_window(grown_raster, data, x_off + window[0], y_off + window[1])
+        old_raster = None
+        grown_raster = None
+        os.replace(grown_path, path)
+    return True
+
+
+def get_provenance_path(composite_path):
+    """The provenance raster of a composite has the same name as the composite, but with a .prov extension. It is
+    uint16; its first band is the acquisition date of each pixel of the composite, as days since 1970-01-01 (see
+    get_days_since_epoch), and its second is the number of clear observations of that pixel. 0 means unknown."""
+    composite_name = os.path.basename(composite_path)
+    composite_dir = os.path.dirname(composite_path)
+    provenance_name = composite_name.rsplit('.')[0] + ".prov"
+    return os.path.join(composite_dir, provenance_name)
+
+
+def open_provenance_dataset(composite, provenance_path):
+    """Opens the provenance raster at provenance_path for update, creating it (every pixel 0) if it does not exist"""
+    if os.path.exists(provenance_path):
+        return open_matching_dataset_for_update(composite, provenance_path)
+    return create_matching_dataset(composite, provenance_path, bands=2, datatype=gdal.GDT_UInt16)
+
+
+def get_days_since_epoch(date):
+    """Returns the number of whole days between 1970-01-01 and a datetime; fits in a uint16 until 2149"""
+    return (date - dt.datetime(1970, 1, 1)).days
+
+
+def composite_directory(image_dir, composite_out_dir, format="GTiff", method="latest", percentile=50, n_jobs=1,
+                        mem_limit=None, provenance=False):
     """Composites every image in image_dir, assumes all have associated masks.  Will
-     place a file named composite_[last image date].tif inside composite_out_dir"""
+     place a file named composite_[last image date].tif inside composite_out_dir. See composite_images_with_mask
+     for method, percentile, n_jobs, mem_limit and provenance."""
     log = logging.getLogger(__name__)
 
     log.info("Compositing {}".format(image_dir))
@@ -744,28 +1508,38 @@ def composite_directory(image_dir, composite_out_dir, format="GTiff"):
                           if image_name.endswith(".tif")]
     last_timestamp = get_s2_image_acquisition_time(sorted_image_paths[-1])
     composite_out_path = os.path.join(composite_out_dir, "composite_{}.tif".format(last_timestamp.strftime("%Y%m%dT%H%M%S")))
-    composite_images_with_mask(sorted_image_paths, composite_out_path, format)
+    composite_images_with_mask(sorted_image_paths, composite_out_path, format, n_jobs, mem_limit, method, percentile,
+                               provenance)
+    return composite_out_path
 
 
 def change_from_composite(image_path, composite_path, model_path, class_out_path, prob_out_path):
     """Generates a change map comparing an image with a composite"""
     with TemporaryDirectory() as td:
-        stacked_path = os.path.join(td, "comp_stack.tif")
-        stack_images((composite_path, image_path), stacked_path)
+        stacked_path = os.path.join(td, "comp_stack.vrt")
+        stack_images_virtual((composite_path, image_path), stacked_path)
         classify_image(stacked_path, model_path, class_out_path, prob_out_path)
 
 
 def get_masked_array(raster, mask_path, fill_value = -9999):
     """Returns a numpy.mask masked array for the raster.
     Masked pixels are FALSE in the mask image (multiplicateive map),
-    but TRUE in the masked_array (nodata pixels)"""
+    but TRUE in the masked_array (nodata pixels). A single-band mask of a multi-band raster is broadcast across the
+    bands rather than copied into each of them."""
     mask = gdal.Open(mask_path)
-    mask_array = mask.GetVirtualMemArray()
+    masked = np.logical_not(mask.GetVirtualMemArray())
     raster_array = raster.GetVirtualMemArray()
-    # If the shapes do not match, assume single-band mask for multi-band raster
-    if len(mask_array.shape) == 2 and len(raster_array.shape) == 3:
-        mask_array = project_array(mask_array, raster_array.shape[0], 0)
-    return np.ma.array(raster_array, mask=np.logical_not(mask_array))
+    return np.ma.array(raster_array, mask=np.broadcast_to(masked, raster_array.shape))
+
+
+def read_mask_window(mask, window=None):
+    """Returns a boolean [band, y, x] array, True where a multiplicative mask dataset is clear (non-zero), of an
+    (x_offset, y_offset, x_size, y_size) window of it (the whole mask if None). A single-band mask gives a
+    [1, y, x] array, which numpy broadcasts against every band of an image window without copying it."""
+    if window is None:
+        window = (0, 0, mask.RasterXSize, mask.RasterYSize)
+    x_size, y_size = window[2], window[3]
+    return (mask.ReadAsArray(*window) != 0).reshape((mask.RasterCount, y_size, x_size))
 
 
 def project_array(array_in, depth, axis):
@@ -776,9 +1550,18 @@ def project_array(array_in, depth, axis):
 
 
 def flatten_probability_image(prob_image, out_path):
-    """Produces a single-band raster containing the highest certainties in a input probablility raster"""
+    """Produces a single-band raster containing the highest certainties in a input probablility raster.
+    The output has the same datatype as the input and, for quantized probability rasters (see quantize_probs),
+    the same scale and offset."""
     prob_raster = gdal.Open(prob_image)
     out_raster = create_matching_dataset(prob_raster, out_path, bands=1)
+    in_band = prob_raster.GetRasterBand(1)
+    if in_band.GetScale() not in (None, 1):
+        out_band = out_raster.GetRasterBand(1)
+        out_band.SetScale(in_band.GetScale())
+        out_band.SetOffset(in_band.GetOffset() or 0)
+        out_band = None
+    in_band = None
     prob_array = prob_raster.GetVirtualMemArray()
     out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
     out_array[:, :] = prob_array.max(axis=0)
@@ -786,6 +1569,7 @@ def flatten_probability_image(prob_image, out_path):
     prob_array = None
     out_raster = None
     prob_raster = None
+    finalise_output(out_path)
 
 
 def get_combined_polygon(rasters, geometry_mode ="intersect"):
@@ -893,6 +1677,7 @@ def clip_raster(raster_path, aoi_path, out_path, srs_id=4326):
         write_polygon(intersection, intersection_path)
         clip_spec = gdal.WarpOptions(
             format="GTiff",
+            creationOptions=get_creation_options("GTiff", raster.GetRasterBand(1).DataType),
             cutlineDSName=intersection_path,
             cropToCutline=True,
             width=width_pix,
@@ -1012,46 +1797,246 @@ def get_poly_size(poly):
 
 def create_mask_from_model(image_path, model_path, model_clear = 0):
     """Returns a multiplicative mask (0 for cloud, shadow or haze, 1 for clear) built from the model."""
-    with TemporaryDirectory() as td:
-        log = logging.getLogger(__name__)
-        log.info("Building cloud mask for {}".format(image_path))
-        temp_mask_path = os.path.join(td, "cat_mask.tif")
-        classify_image(image_path, model_path, temp_mask_path)
-        temp_mask = gdal.Open(temp_mask_path, gdal.GA_Update)
-        temp_mask_array = temp_mask.GetVirtualMemArray()
-        mask_path = get_mask_path(image_path)
-        mask = create_matching_dataset(temp_mask, mask_path, datatype=gdal.GDT_Byte)
-        mask_array = mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
-        mask_array[:, :] = np.where(temp_mask_array != model_clear, 0, 1)
-        temp_mask_array = None
-        mask_array = None
-        temp_mask = None
-        mask = None
-        log.info("Cloud mask for {} saved in {}".format(image_path, mask_path))
-        return mask_path
+    log = logging.getLogger(__name__)
+    log.info("Building cloud mask for {}".format(image_path))
+    nodata = get_nodata_array(image_path)
+    cloud = ~get_model_mask_array(image_path, model_path, model_clear) & ~nodata
+    mask_path = write_mask(image_path, ~(cloud | nodata), {"cloud": cloud, "nodata": nodata})
+    log.info("Cloud mask for {} saved in {}".format(image_path, mask_path))
+    return mask_path
 
 
 def create_mask_from_confidence_layer(image_path, l2_safe_path, cloud_conf_threshold = 30):
-    """Creates a binary mask where pixels under the cloud confidence threshold are TRUE"""
+    """Creates a binary mask where pixels under the cloud confidence threshold are TRUE. Pixels with no data in the
+    image are FALSE (see get_nodata_array)."""
+    nodata = get_nodata_array(image_path)
+    cloud = ~get_confidence_mask_array(image_path, l2_safe_path, cloud_conf_threshold)
+    return write_mask(image_path, ~(cloud | nodata), {"cloud": cloud, "nodata": nodata})
+
+
+def create_mask_from_model_and_confidence_layer(image_path, l2_safe_path, model_path, cloud_conf_threshold=30,
+                                                model_clear=0):
+    """Creates a multiplicative mask where pixels are 1 only if they are under the cloud confidence threshold and
+    the model classes them as model_clear. Both masks are built in memory and the .msk is written once."""
     log = logging.getLogger(__name__)
+    log.info("Building cloud mask for {} from the confidence layer and model".format(image_path))
+    nodata = get_nodata_array(image_path)
+    clear = get_confidence_mask_array(image_path, l2_safe_path, cloud_conf_threshold)
+    clear &= get_model_mask_array(image_path, model_path, model_clear)
+    cloud = ~clear & ~nodata
+    return write_mask(image_path, ~(cloud | nodata), {"cloud": cloud, "nodata": nodata})
+
+
+def create_mask_from_scene_classification(image_path, l2_safe_path, cloud_conf_threshold=30, conditions=None):
+    """Creates a multiplicative mask from the sen2cor scene classification (SCL) and cloud confidence layers of
+    l2_safe_path, masking the pixels where any of conditions (a list of mask_flags names; all of them by default)
+    hold. The conditions of every pixel are also written to the image's flags raster (see get_scl_flags_array), so
+    the mask can be rebuilt with other conditions by create_mask_from_flags. This needs no model, and gives masks
+    close to those of create_mask_from_model for the cost of reading two 20m layers."""
+    log = logging.getLogger(__name__)
+    log.info("Building cloud mask for {} from the scene classification layer".format(image_path))
+    flags = get_scl_flags_array(image_path, l2_safe_path, cloud_conf_threshold)
+    flags[get_nodata_array(image_path)] |= mask_flags["nodata"]
+    mask_path = write_mask(image_path, get_clear_from_flags(flags, conditions))
+    write_mask_flags(image_path, flags)
+    log.info("Cloud mask for {} saved in {}".format(image_path, mask_path))
+    return mask_path
+
+
+def get_scl_flags_array(image_path, l2_safe_path, cloud_conf_threshold=30):
+    """Returns a uint8 [y, x] array of packed mask flags (see pack_mask_flags) on the grid of image_path. The flags
+    of each pixel are looked up from its class in the SCL layer of l2_safe_path (see get_scl_lut), and the cloud
+    flag is also set where the cloud confidence layer is at or over cloud_conf_threshold. Both layers are combined
+    at 20m and then upsampled once (see upsample_array)."""
+    scl_glob = "GRANULE/*/IMG_DATA/R20m/*_SCL_20m.jp2"
+    cloud_glob = "GRANULE/*/QI_DATA/MSK_CLDPRB_20m.jp2"
+    scl_image = gdal.Open(glob.glob(os.path.join(l2_safe_path, scl_glob))[0])
+    cloud_image = gdal.Open(glob.glob(os.path.join(l2_safe_path, cloud_glob))[0])
+    flags = get_scl_lut()[scl_image.GetRasterBand(1).ReadAsArray().astype(np.uint8)]
+    flags[cloud_image.GetRasterBand(1).ReadAsArray() >= cloud_conf_threshold] |= mask_flags["cloud"]
+    image = gdal.Open(image_path)
+    factor, offset = get_upsampling(scl_image, image)
+    flags = upsample_array(flags, factor, (image.RasterYSize, image.RasterXSize), offset)
+    scl_image = None
+    cloud_image = None
+    image = None
+    return flags
+
+
+def get_scl_lut(scl_conditions=None):
+    """Returns a 256 entry uint8 lookup table from sen2cor scene classification values to packed mask flags.
+    scl_conditions is a dictionary of SCL values to the mask_flags name they set; scl_mask_conditions by default."""
+    if scl_conditions is None:
+        scl_conditions = scl_mask_conditions
+    lut = np.zeros(256, dtype=np.uint8)
+    for scl_class, name in scl_conditions.items():
+        lut[scl_class] |= mask_flags[name]
+    return lut
+
+
+def get_confidence_mask_array(image_path, l2_safe_path, cloud_conf_threshold=30):
+    """Returns a boolean [y, x] array on the grid of image_path that is True where the sen2cor cloud confidence
+    layer of l2_safe_path is under cloud_conf_threshold. The 20m confidence layer is read once and upsampled to the
+    image's resolution by replicating each pixel (see upsample_array)."""
     cloud_glob = "GRANULE/*/QI_DATA/MSK_CLDPRB_20m.jp2"
     cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
     cloud_image = gdal.Open(cloud_path)
-    cloud_confidence_array = cloud_image.GetVirtualMemArray()
-    mask_array = (cloud_confidence_array < cloud_conf_threshold)
-    cloud_confidence_array = None
+    clear = cloud_image.GetRasterBand(1).ReadAsArray() < cloud_conf_threshold
+    image = gdal.Open(image_path)
+    factor, offset = get_upsampling(cloud_image, image)
+    clear = upsample_array(clear, factor, (image.RasterYSize, image.RasterXSize), offset)
+    cloud_image = None
+    image = None
+    return clear
+
+
+def get_model_mask_array(image_path, model_path, model_clear=0):
+    """Returns a boolean [y, x] array that is True where model classifies image_path as model_clear. The image is
+    classified window by window straight into the array; no class map is written. Pixels with no data are False."""
+    image = gdal.Open(image_path)
+    model = load_model(model_path)
+    model.n_jobs = -1
+    clear = np.empty((image.RasterYSize, image.RasterXSize), dtype=bool)
+    for window in plan_windows(image, n_classes=model.n_classes_):
+        x_off, y_off, x_size, y_size = window
+        classes, _ = classify_window(model, image, window, nodata_class=-1)
+        clear[y_off: y_off + y_size, x_off: x_off + x_size] = classes == model_clear
+    image = None
+    return clear
+
+
+def get_nodata_array(image_path):
+    """Returns a boolean [y, x] array that is True where every band of image_path is equal to its nodata value, or
+    to 0 if it has none. The image is read block by block."""
+    image = gdal.Open(image_path)
+    nodata = image.GetRasterBand(1).GetNoDataValue()
+    if nodata is None:
+        nodata = 0
+    out = np.empty((image.RasterYSize, image.RasterXSize), dtype=bool)
+    for window in get_block_windows(image):
+        x_off, y_off, x_size, y_size = window
+        block = image.ReadAsArray(*window)
+        if block.ndim == 2:
+            block = block[np.newaxis, ...]
+        out[y_off: y_off + y_size, x_off: x_off + x_size] = np.all(block == nodata, axis=0)
+    image = None
+    return out
 
+
+def get_upsampling(coarse_raster, fine_raster):
+    """Returns the integer factor between the pixel sizes of coarse_raster and fine_raster, and the (y, x) offset in
+    fine pixels of fine_raster's origin from coarse_raster's, for use with upsample_array. Raises a
+    ForestSentinelException if the pixel sizes are not a whole multiple of each other or the grids are not aligned."""
+    coarse_gt = coarse_raster.GetGeoTransform()
+    fine_gt = fine_raster.GetGeoTransform()
+    if coarse_gt[2] or coarse_gt[4] or fine_gt[2] or fine_gt[4]:
+        raise ForestSentinelException("Cannot upsample between rotated grids")
+    x_ratio = coarse_gt[1] / fine_gt[1]
+    y_ratio = coarse_gt[5] / fine_gt[5]
+    factor = int(round(x_ratio))
+    if factor < 1 or not np.isclose(x_ratio, factor) or not np.isclose(y_ratio, factor):
+        raise ForestSentinelException("Pixel sizes {} and {} are not a whole multiple of each other".format(
+            (coarse_gt[1], coarse_gt[5]), (fine_gt[1], fine_gt[5])))
+    x_off = (fine_gt[0] - coarse_gt[0]) / fine_gt[1]
+    y_off = (fine_gt[3] - coarse_gt[3]) / fine_gt[5]
+    if not np.isclose(x_off, round(x_off)) or not np.isclose(y_off, round(y_off)):
+        raise ForestSentinelException("Grids with origins {} and {} are not aligned".format(
+            (coarse_gt[0], coarse_gt[3]), (fine_gt[0], fine_gt[3])))
+    return factor, (int(round(y_off)), int(round(x_off)))
+
+
+def upsample_array(array, factor, shape=None, offset=(0, 0)):
+    """Returns a copy of a [y, x] array with each pixel repeated factor times in each direction. The copy starts at
+    the (y, x) offset in the upsampled grid and has the given shape, [y*factor, x*factor] by default; pixels outside
+    the array repeat its edge pixels."""
+    if shape is None:
+        shape = (array.shape[0] * factor, array.shape[1] * factor)
+    rows = np.clip((offset[0] + np.arange(shape[0])) // factor, 0, array.shape[0] - 1)
+    cols = np.clip((offset[1] + np.arange(shape[1])) // factor, 0, array.shape[1] - 1)
+    return array[rows[:, np.newaxis], cols]
+
+
+def write_mask(image_path, mask_array, conditions=None):
+    """Writes a boolean [y, x] mask array to the .msk of image_path (see get_mask_path) as a 1-bit raster matching
+    the image, 1 where the array is True. If conditions, a dictionary of mask_flags names to boolean [y, x] arrays
+    that are True where that condition holds, is given, they are also written to the image's flags raster (see
+    write_mask_flags). Returns the mask path."""
+    image = gdal.Open(image_path)
     mask_path = get_mask_path(image_path)
-    mask_image = create_matching_dataset(cloud_image, mask_path)
-    mask_image_array = mask_image.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    np.copyto(mask_image_array, mask_array)
-    mask_image_array = None
-    cloud_image = None
-    mask_image = None
-    resample_image_in_place(mask_path, 10)
+    mask = create_matching_dataset(image, mask_path, datatype=gdal.GDT_Byte, nbits=1)
+    write_window(mask, mask_array.astype(np.uint8), 0, 0)
+    mask = None
+    image = None
+    if conditions:
+        write_mask_flags(image_path, pack_mask_flags(conditions))
+    return mask_path
+
+
+def pack_mask_flags(conditions):
+    """Packs a dictionary of mask_flags names to boolean [y, x] arrays, True where that condition holds, into a
+    single uint8 [y, x] array with the bit of each condition set where it holds"""
+    unknown = set(conditions) - set(mask_flags)
+    if unknown:
+        raise ForestSentinelException("Unknown mask conditions {}; use one of {}".format(
+            sorted(unknown), sorted(mask_flags)))
+    flags = None
+    for name, condition in conditions.items():
+        bits = np.where(condition, np.uint8(mask_flags[name]), np.uint8(0))
+        flags = bits if flags is None else flags | bits
+    return flags
+
+
+def get_clear_from_flags(flags, conditions=None):
+    """Returns a boolean array that is True where none of conditions (a list of mask_flags names; all of them by
+    default) are set in an array of packed mask flags"""
+    if conditions is None:
+        conditions = mask_flags.keys()
+    bits = 0
+    for name in conditions:
+        bits |= mask_flags[name]
+    return (flags & bits) == 0
+
+
+def write_mask_flags(image_path, flags):
+    """Writes a uint8 [y, x] array of packed mask flags (see pack_mask_flags) to the flags raster of image_path (see
+    get_mask_flags_path), stored in as many bits as mask_flags needs. Returns the path of the flags raster."""
+    image = gdal.Open(image_path)
+    flags_path = get_mask_flags_path(image_path)
+    nbits = max(mask_flags.values()).bit_length()
+    flags_raster = create_matching_dataset(image, flags_path, datatype=gdal.GDT_Byte, nbits=nbits)
+    write_window(flags_raster, flags.astype(np.uint8), 0, 0)
+    flags_raster = None
+    image = None
+    return flags_path
+
+
+def create_mask_from_flags(image_path, conditions=None):
+    """Rewrites the .msk of image_path from its flags raster, masking the pixels where any of conditions (a list of
+    mask_flags names; all of them by default) are set. Masks can be rebuilt this way with different conditions
+    without recomputing them. Each block of flags is written straight to the mask. Returns the mask path."""
+    image = gdal.Open(image_path)
+    flags_raster = gdal.Open(get_mask_flags_path(image_path))
+    mask_path = get_mask_path(image_path)
+    mask = create_matching_dataset(image, mask_path, datatype=gdal.GDT_Byte, nbits=1)
+    for window in get_block_windows(flags_raster):
+        x_off, y_off, x_size, y_size = window
+        clear = get_clear_from_flags(flags_raster.ReadAsArray(*window), conditions)
+        write_window(mask, clear.astype(np.uint8), x_off, y_off)
+    mask = None
+    flags_raster = None
+    image = None
     return mask_path
 
 
+def get_mask_flags_path(image_path):
+    """The flags raster of an image has the same name as the image, but with a .qa extension. Each of its pixels
+    packs one bit for each condition in mask_flags that holds there."""
+    image_name = os.path.basename(image_path)
+    image_dir = os.path.dirname(image_path)
+    flags_name = image_name.rsplit('.')[0] + ".qa"
+    return os.path.join(image_dir, flags_name)
+
+
 def get_mask_path(image_path):
     """A gdal mask is an image with the same name as the image it's masking, but with a .msk extension"""
     image_name = os.path.basename(image_path)
@@ -1061,10 +2046,25 @@ def get_mask_path(image_path):
     return mask_path
 
 
-def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func ="intersect"):
+def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func ="intersect", threshold=None,
+                  mem_limit=None):
     """ORs or ANDs several masks. Gets metadata from top mask. Assumes that masks are a
-    Python true or false """
-    # TODO Implement intersection and union
+    Python true or false, and that they share a pixel grid.
+    The output covers the intersection or union (geometry_func) of the masks, and a pixel of it is 1 if:
+    or: it is clear in any mask that covers it
+    and: it is clear in every mask that covers it
+    nor: it is clear in none of the masks that cover it
+    count: it is clear in at least threshold masks
+    Pixels covered by no mask are 0. The output is built one block-aligned window at a time, sized to fit in
+    mem_limit bytes; each window reads only the masks that overlap it (see get_rasters_in_windows), and masks are
+    only held open while there are windows left that need them."""
+    log = logging.getLogger(__name__)
+    if combination_func not in ("or", "and", "nor", "count"):
+        raise ForestSentinelException("Invalid combination_func; valid values are 'or', 'and', 'nor' and 'count'")
+    if combination_func == "count" and threshold is None:
+        raise ForestSentinelException("Combining masks by count needs a threshold")
+    if geometry_func not in ("intersect", "union"):
+        raise ForestSentinelException("Invalid geometry_func; can be 'intersect' or 'union'")
     masks = [gdal.Open(mask_path) for mask_path in mask_paths]
     combined_polygon = get_combined_polygon(masks, geometry_func)
     gt = masks[0].GetGeoTransform()
@@ -1073,42 +2073,63 @@ def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func
     bands = 1
     projection = masks[0].GetProjection()
     out_mask = create_new_image_from_polygon(combined_polygon, out_path, x_res, y_res,
-                                             bands, projection, datatype=gdal.GDT_Byte, nodata=0)
-
-    # This bit here is similar to stack_raster, but different enough to not be worth spinning into a combination_func
-    # I might reconsider this later, but I think it'll overcomplicate things.
-    out_mask_array = out_mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    for in_mask in masks:
-        in_mask_array = in_mask.GetVirtualMemArray()
-        if geometry_func == "intersect":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, combined_polygon)
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, combined_polygon)
-        elif geometry_func == "union":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, get_raster_bounds(in_mask))
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, get_raster_bounds(in_mask))
-        else:
-            raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
-        out_mask_view = out_mask_array[out_y_min: out_y_max, out_x_min: out_x_max]
-        in_mask_view = in_mask_array[in_y_min: in_y_max, in_x_min: in_x_max]
-        if combination_func is 'or':
-            out_mask_view = np.bitwise_or(out_mask_view, in_mask_view)
-        elif combination_func is 'and':
-            out_mask_view = np.bitwise_and(out_mask_view, in_mask_view)
-        elif combination_func is 'nor':
-            out_mask_view = np.bitwise_not(np.bitwise_or(out_mask_view, in_mask_view))
-        else:
-            raise Exception("Invalid combination_func; valid values are 'or', 'and', and 'nor'")
-        in_mask_view = None
-        out_mask_view = None
-        in_mask_array = None
-    out_mask_array = None
+                                             bands, projection, datatype=gdal.GDT_Byte, nodata=0, nbits=1)
+    out_gt = out_mask.GetGeoTransform()
+    windows = plan_windows(out_mask, mem_limit, bytes_per_pixel=len(masks) + 5)
+    window_masks = get_rasters_in_windows(out_gt, windows, masks)
+    masks = None
+    # The last window each mask is needed for, so it can be closed after that
+    last_window = {}
+    for window_index, mask_indices in enumerate(window_masks):
+        last_window.update((mask_index, window_index) for mask_index in mask_indices)
+    log.info("Combining {} masks into {} in {} windows".format(len(mask_paths), out_path, len(windows)))
+    open_masks = {}
+    for window_index, (window, mask_indices) in enumerate(zip(windows, window_masks)):
+        for mask_index in mask_indices:
+            if mask_index not in open_masks:
+                open_masks[mask_index] = gdal.Open(mask_paths[mask_index])
+        combined = combine_mask_window([open_masks[mask_index] for mask_index in mask_indices], out_gt, window,
+                                       combination_func, threshold)
+        write_window(out_mask, combined, window[0], window[1])
+        for mask_index in mask_indices:
+            if last_window[mask_index] == window_index:
+                del open_masks[mask_index]
     out_mask = None
     return out_path
 
 
+def combine_mask_window(masks, out_gt, window, combination_func="and", threshold=None):
+    """Returns a uint8 [y, x] array of an (x_offset, y_offset, x_size, y_size) window of a raster with geotransform
+    out_gt, combining masks as combine_masks does. The masks are read into one [mask, y, x] stack, which is then
+    reduced in a single pass over the number of masks that are clear and that cover each pixel."""
+    x_off, y_off, x_size, y_size = window
+    # 2 where a mask does not cover the pixel
+    stack = np.full((len(masks), y_size, x_size), 2, dtype=np.uint8)
+    for layer, mask in zip(stack, masks):
+        overlap = get_window_overlap(out_gt, window, mask)
+        if overlap is None:
+            continue
+        (out_x, out_y), in_window = overlap
+        layer[out_y: out_y + in_window[3], out_x: out_x + in_window[2]] = read_mask_window(mask, in_window).any(axis=0)
+    n_clear = np.count_nonzero(stack == 1, axis=0)
+    n_covering = np.count_nonzero(stack != 2, axis=0)
+    if combination_func == "or":
+        combined = n_clear > 0
+    elif combination_func == "and":
+        combined = (n_clear == n_covering) & (n_covering > 0)
+    elif combination_func == "nor":
+        combined = (n_clear == 0) & (n_covering > 0)
+    elif combination_func == "count":
+        combined = n_clear >= threshold
+    else:
+        raise ForestSentinelException("Invalid combination_func; valid values are 'or', 'and', 'nor' and 'count'")
+    return combined.astype(np.uint8)
+
+
 def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
-                           projection, format="GTiff", datatype = gdal.GDT_Int32, nodata = -9999):
-    """Returns an empty image of the extent of input polygon"""
+                           projection, format="GTiff", datatype = gdal.GDT_Int32, nodata = -9999, nbits=None):
+    """Returns an empty image of the extent of input polygon, laid out as in the output profile if a GeoTIFF.
+    nbits is passed to get_creation_options."""
     # TODO: Implement nodata
     bounds_x_min, bounds_x_max, bounds_y_min, bounds_y_max = polygon.GetEnvelope()
     final_width_pixels = int((bounds_x_max - bounds_x_min) / x_res)
@@ -1116,7 +2137,7 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
     driver = gdal.GetDriverByName(format)
     out_raster = driver.Create(
         out_path, xsize=final_width_pixels, ysize=final_height_pixels,
-        bands=bands, eType=datatype
+        bands=bands, eType=datatype, options=get_creation_options(format, datatype, nbits)
     )
     out_raster.SetGeoTransform([
         bounds_x_min, x_res, 0,
@@ -1130,10 +2151,13 @@ def resample_image_in_place(image_path, new_res):
     """Resamples an image in-place using gdalwarp to new_res in metres"""
     # I don't like using a second object here, but hey.
     with TemporaryDirectory() as td:
+        image = gdal.Open(image_path)
         args = gdal.WarpOptions(
             xRes=new_res,
-            yRes=new_res
+            yRes=new_res,
+            creationOptions=get_creation_options("GTiff", image.GetRasterBand(1).DataType)
         )
+        image = None
         temp_image = os.path.join(td, "temp_image.tif")
         gdal.Warp(temp_image, image_path, options=args)
         shutil.move(temp_image, image_path)
@@ -1148,82 +2172,657 @@ def apply_array_image_mask(array, mask):
 
 
 def classify_image(image_path, model_path, class_out_dir, prob_out_path=None,
-                   apply_mask=False, out_type="GTiff", num_chunks=None):
-    """Classifies change in an image. Images need to be chunked, otherwise they cause a memory error (~16GB of data
-    with a ~15GB machine)"""
+                   apply_mask=False, out_type="GTiff", num_chunks=None, windowed=False, n_jobs=1, mem_limit=None,
+                   nodata_class=0, nodata_prob=0, in_nodata=(0, -9999), prob_dtype="float32", footprint=None):
+    """Classifies change in an image. model_path can also be a model that has already been loaded with
+    load_model. Unless num_chunks is given and windowed is False, the image is classified in windows that fit in
+    mem_limit bytes (see classify_image_windowed), on n_jobs processes (-1 for all cores). Otherwise the whole image
+    is read in and classified in num_chunks chunks of pixels.
+    Pixels that are masked (if apply_mask is True) or have no data (see get_valid_pixels) are written as
+    nodata_class in the class map and nodata_prob in every band of the probability map, which is stored as
+    prob_dtype ("float32", "uint16" or "uint8"; see quantize_probs).
+    If a footprint (a polygon, or a mask raster path such as the new image's .msk) is given, only the windows with
+    data in it are classified (see get_windows_in_footprint) and existing outputs are updated in place, so the cost
+    scales with how much of the stack is new data. Implies windowed."""
     log = logging.getLogger(__name__)
+    if n_jobs != 1:
+        return classify_image_parallel(image_path, model_path, class_out_dir, prob_out_path, apply_mask, out_type,
+                                       n_jobs, mem_limit, nodata_class, nodata_prob, in_nodata, prob_dtype,
+                                       footprint)
+    if windowed or num_chunks is None or footprint is not None:
+        return classify_image_windowed(image_path, model_path, class_out_dir, prob_out_path, apply_mask, out_type,
+                                       mem_limit, nodata_class, nodata_prob, in_nodata, prob_dtype, footprint)
     log.info("Starting classification for {} with model {}".format(image_path, model_path))
     image = gdal.Open(image_path)
-    if num_chunks == None:
-        log.info("No chunk size given, attempting autochunk.")
-        num_chunks = autochunk(image)
-        log.info("Autochunk to {} chunks".format(num_chunks))
-    model = joblib.load(model_path)
+    model = load_model(model_path)
     map_out_image = create_matching_dataset(image, class_out_dir, format=out_type)
     if prob_out_path:
-        prob_out_image = create_matching_dataset(image, prob_out_path, bands=model.n_classes_, datatype=gdal.GDT_Float32)
-    model.n_cores = -1
-    image_array = image.GetVirtualMemArray()
+        prob_out_image = create_prob_dataset(image, prob_out_path, model.n_classes_, prob_dtype)
+    model.n_jobs = -1
+    image_array = get_virtual_ml_array(image)
+    mask_values = None
     if apply_mask:
         mask_path = get_mask_path(image_path)
         log.info("Applying mask at {}".format(mask_path))
         mask = gdal.Open(mask_path)
-        mask_array = mask.GetVirtualMemArray()
-        image_array = apply_array_image_mask(image_array, mask_array)
-        mask_array = None
+        mask_values = mask.GetRasterBand(1).ReadAsArray().ravel()
         mask = None
-    image_array = reshape_raster_for_ml(image_array)
+    valid = get_valid_pixels(image_array, mask_values, in_nodata, getattr(model, "pyeo_bands_per_image", 4))
+    mask_values = None
+    log.info("{} of {} pixels are valid".format(np.count_nonzero(valid), valid.size))
     n_samples = image_array.shape[0]
     classes = np.empty(n_samples, dtype=np.int16)
     if prob_out_path:
-        probs = np.empty((n_samples, model.n_classes_), dtype=np.float32)
+        probs = np.empty((n_samples, model.n_classes_), dtype=prob_dtype)
 
-    if n_samples % num_chunks != 0:
-        raise ForestSentinelException("Please pick a chunk size that divides evenly")
-    chunk_size = int(n_samples / num_chunks)
+    # Chunks are allowed to be ragged; the first n_samples % num_chunks chunks are one pixel longer
+    chunk_edges = np.linspace(0, n_samples, num_chunks + 1).astype(np.int64)
     for chunk_id in range(num_chunks):
         log.info("Processing chunk {}".format(chunk_id))
-        chunk_view = image_array[
-            chunk_id*chunk_size: chunk_id * chunk_size + chunk_size, :
-        ]
-        out_view = classes[
-            chunk_id * chunk_size: chunk_id * chunk_size + chunk_size
-        ]
-        out_view[:] = model.predict(chunk_view)
+        chunk_start, chunk_end = chunk_edges[chunk_id], chunk_edges[chunk_id + 1]
+        chunk_view = image_array[chunk_start: chunk_end, :]
+        out_view = classes[chunk_start: chunk_end]
+        chunk_classes, chunk_probs = classify_valid_pixels(model, chunk_view, valid[chunk_start: chunk_end],
+                                                           bool(prob_out_path), nodata_class, nodata_prob,
+                                                           prob_dtype)
+        out_view[:] = chunk_classes
         if prob_out_path:
-            prob_view = probs[
-                chunk_id * chunk_size: chunk_id * chunk_size + chunk_size, :
-            ]
-            prob_view[:, :] = model.predict_proba(chunk_view)
+            prob_view = probs[chunk_start: chunk_end, :]
+            prob_view[:, :] = chunk_probs
     map_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[:, :] = reshape_ml_out_to_raster(classes, image.RasterXSize, image.RasterYSize)
     if prob_out_path:
-        prob_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[:, :, :] = reshape_prob_out_to_raster(probs, image.RasterXSize, image.RasterYSize)
+        prob_out_array = prob_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write, band_sequential=False)
+        prob_out_array[...] = np.reshape(probs, prob_out_array.shape)
+        prob_out_array = None
     map_out_image = None
     prob_out_image = None
+    finalise_output(class_out_dir)
+    if prob_out_path:
+        finalise_output(prob_out_path)
     if prob_out_path:
         return class_out_dir, prob_out_path
     else:
         return class_out_dir
 
 
+def classify_image_windowed(image_path, model_path, class_out_path, prob_out_path=None,
+                            apply_mask=False, out_type="GTiff", mem_limit=None,
+                            nodata_class=0, nodata_prob=0, in_nodata=(0, -9999), prob_dtype="float32",
+                            footprint=None):
+    """Classifies an image one window at a time, reading a block-aligned window of the image, predicting it and
+    writing the classes (and probabilities, if prob_out_path is given) for that window straight to disk. Windows are
+    planned by plan_windows so that classifying one takes no more than mem_limit bytes; peak memory is bounded by
+    the window size rather than the size of the image. Masked and nodata pixels are skipped, and a footprint
+    limits classification to the windows it intersects, as in classify_image."""
+    log = logging.getLogger(__name__)
+    log.info("Starting windowed classification for {} with model {}".format(image_path, model_path))
+    image = gdal.Open(image_path)
+    model = load_model(model_path)
+    model.n_jobs = -1
+    map_out_image, prob_out_image = create_classification_outputs(image, model.n_classes_, class_out_path,
+                                                                  prob_out_path, out_type, prob_dtype,
+                                                                  update=footprint is not None)
+    mask = None
+    if apply_mask:
+        mask_path = get_mask_path(image_path)
+        log.info("Applying mask at {}".format(mask_path))
+        mask = gdal.Open(mask_path)
+    n_classes = model.n_classes_ if prob_out_image is not None else 0
+    windows = plan_windows(image, mem_limit, n_classes)
+    if footprint is not None:
+        windows = get_windows_in_footprint(image, windows, footprint)
+    log.info("Classifying {} windows".format(len(windows)))
+    for window in windows:
+        classes, probs = classify_window(model, image, window, mask, prob_out_image is not None,
+                                         nodata_class, nodata_prob, in_nodata, prob_dtype)
+        write_window(map_out_image, classes, window[0], window[1])
+        if prob_out_image is not None:
+            write_window(prob_out_image, probs, window[0], window[1])
+    map_out_image = None
+    prob_out_image = None
+    mask = None
+    image = None
+    # Outputs updated within a footprint only need the overviews of the windows that changed
+    updated_windows = windows if footprint is not None else None
+    finalise_output(class_out_path, updated_windows)
+    if prob_out_path:
+        finalise_output(prob_out_path, updated_windows)
+    if prob_out_path:
+        return class_out_path, prob_out_path
+    else:
+        return class_out_path
+
+
+def classify_image_parallel(image_path, model_path, class_out_path, prob_out_path=None,
+                            apply_mask=False, out_type="GTiff", n_jobs=-1, mem_limit=None,
+                            nodata_class=0, nodata_prob=0, in_nodata=(0, -9999), prob_dtype="float32",
+                            footprint=None):
+    """Classifies an image on n_jobs processes (-1 for all cores); see classify_images_parallel"""
+    classify_images_parallel([image_path], model_path, [class_out_path], [prob_out_path], apply_mask, out_type,
+                             n_jobs, mem_limit, nodata_class, nodata_prob, in_nodata, prob_dtype, [footprint])
+    if prob_out_path:
+        return class_out_path, prob_out_path
+    else:
+        return class_out_path
+
+
+def classify_images_parallel(image_paths, model_path, class_out_paths, prob_out_paths=None,
+                             apply_mask=False, out_type="GTiff", n_jobs=-1, mem_limit=None,
+                             nodata_class=0, nodata_prob=0, in_nodata=(0, -9999), prob_dtype="float32",
+                             footprints=None):
+    """Classifies every image in image_paths on one pool of n_jobs processes (-1 for all cores), each loading the
+    model once, and writes the results to the matching paths in class_out_paths and prob_out_paths (an entry of None
+    skips that probability map). mem_limit is shared between the workers. footprints, if given, is a list of
+    footprints (or None) for each image; see classify_image. If memory is short, model_path can be a model saved by
+    compile_model, which the workers share rather than each loading a copy."""
+    log = logging.getLogger(__name__)
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if prob_out_paths is None:
+        prob_out_paths = [None]*len(image_paths)
+    if footprints is None:
+        footprints = [None]*len(image_paths)
+    if not mem_limit:
+        mem_limit = get_available_memory()
+    log.info("Starting parallel classification of {} images with model {} on {} processes"
+             .format(len(image_paths), model_path, n_jobs))
+    window_options = {
+        "nodata_class": nodata_class,
+        "nodata_prob": nodata_prob,
+        "in_nodata": in_nodata,
+        "prob_dtype": prob_dtype
+    }
+    # Open outputs for each image being classified, keyed on its index in image_paths
+    jobs = {}
+
+    def start_image(image_index, n_classes):
+        """Creates the outputs of an image and returns the jobs for its windows"""
+        image_path = image_paths[image_index]
+        image = gdal.Open(image_path)
+        footprint = footprints[image_index]
+        map_out_image, prob_out_image = create_classification_outputs(image, n_classes, class_out_paths[image_index],
+                                                                      prob_out_paths[image_index], out_type,
+                                                                      prob_dtype, update=footprint is not None)
+        mask_path = get_mask_path(image_path) if apply_mask else None
+        get_probs = prob_out_image is not None
+        # At least four windows per worker keep the pool busy
+        windows = plan_windows(image, mem_limit // n_jobs, n_classes if get_probs else 0, min_windows=n_jobs*4)
+        if footprint is not None:
+            windows = get_windows_in_footprint(image, windows, footprint)
+        image = None
+        log.info("Queueing {} windows of {}".format(len(windows), image_path))
+        if not windows:
+            return []
+        jobs[image_index] = {
+            "map_out_image": map_out_image,
+            "prob_out_image": prob_out_image,
+            "windows_left": len(windows),
+            "pixels": sum(x_size * y_size for _, _, x_size, y_size in windows),
+            "updated_windows": windows if footprint is not None else None,
+            "start_time": None
+        }
+        return [(image_index, image_path, mask_path, window, get_probs) for window in windows]
+
+    # Workers predict single-threaded and hand each window's results back to this process, which writes them in the
+    # order they were queued, as GeoTIFFs cannot safely be written by several processes at once. At most two windows
+    # per worker are queued at a time, and queueing stays at most one image ahead of writing, so no more than two
+    # images' outputs are open.
+    with multiprocessing.Pool(n_jobs, initializer=init_classification_worker,
+                              initargs=(model_path, window_options)) as pool:
+        n_classes = pool.apply(get_worker_n_classes)
+        images_left = iter(range(len(image_paths)))
+        windows_to_queue = collections.deque()
+        queued = collections.deque()
+        while True:
+            while len(queued) < n_jobs*2:
+                if not windows_to_queue:
+                    # Only start the next image once every image before the current one has been written
+                    if len(jobs) > 1:
+                        break
+                    image_index = next(images_left, None)
+                    if image_index is None:
+                        break
+                    windows_to_queue.extend(start_image(image_index, n_classes))
+                    continue
+                window_job = windows_to_queue.popleft()
+                job = jobs[window_job[0]]
+                # Throughput is timed from when an image's first window is queued
+                if job["start_time"] is None:
+                    job["start_time"] = dt.datetime.now()
+                queued.append(pool.apply_async(classify_window_in_worker, (window_job,)))
+            if not queued:
+                break
+            image_index, window, classes, probs = queued.popleft().get()
+            job = jobs[image_index]
+            write_window(job["map_out_image"], classes, window[0], window[1])
+            if job["prob_out_image"] is not None:
+                write_window(job["prob_out_image"], probs, window[0], window[1])
+            job["windows_left"] -= 1
+            if job["windows_left"] == 0:
+                del jobs[image_index]
+                job["map_out_image"] = None
+                job["prob_out_image"] = None
+                finalise_output(class_out_paths[image_index], job["updated_windows"])
+                if prob_out_paths[image_index]:
+                    finalise_output(prob_out_paths[image_index], job["updated_windows"])
+                log_classification_throughput(image_paths[image_index], job["pixels"], job["start_time"])
+
+
+# Per-process state for classify_images_parallel's workers; filled in by init_classification_worker
+classification_worker_state = {}
+
+
+def init_classification_worker(model_path, window_options=None):
+    """Loads the model once per classify_images_parallel worker process. window_options is a dict of
+    keyword arguments passed to classify_window for every window."""
+    model = load_model(model_path, mmap_mode='r')
+    model.n_jobs = 1
+    classification_worker_state["model"] = model
+    classification_worker_state["window_options"] = window_options or {}
+    classification_worker_state["image_path"] = None
+
+
+def get_worker_n_classes():
+    """Returns the number of classes of a classify_images_parallel worker's model, so that the parent process does
+    not have to load the model itself"""
+    return classification_worker_state["model"].n_classes_
+
+
+def classify_window_in_worker(job):
+    """Classifies an (image_index, image_path, mask_path, window, get_probs) job with the worker's model.
+    The worker keeps the image and mask it last worked on open, since consecutive jobs are usually from the same image.
+    Returns (image_index, window, classes, probs)"""
+    image_index, image_path, mask_path, window, get_probs = job
+    state = classification_worker_state
+    if state["image_path"] != image_path:
+        state["image"] = gdal.Open(image_path)
+        state["mask"] = gdal.Open(mask_path) if mask_path else None
+        state["image_path"] = image_path
+    classes, probs = classify_window(state["model"], state["image"], window, state["mask"], get_probs,
+                                     **state["window_options"])
+    return image_index, window, classes, probs
+
+
+def load_model(model_path, mmap_mode=None):
+    """Loads a pickled model from model_path with joblib. If model_path is already a model, returns it unchanged.
+    mmap_mode is passed to joblib.load; 'r' memory-maps any plain NumPy arrays in the pickle read-only. sklearn's
+    trees copy their node arrays when they are unpickled, so each process that loads a forest still holds its own
+    copy of it; a CompiledForest's arrays stay memory-mapped (see compile_model)."""
+    if not isinstance(model_path, str):
+        return model_path
+    return joblib.load(model_path, mmap_mode=mmap_mode)
+
+
+def log_classification_throughput(image_path, pixels, start_time):
+    """Logs how long an image took to classify since start_time and its throughput in pixels per second"""
+    log = logging.getLogger(__name__)
+    seconds = max((dt.datetime.now() - start_time).total_seconds(), 1e-6)
+    log.info("Classified {} ({} pixels) in {:.1f}s: {:.0f} pixels/s".format(image_path, pixels, seconds,
+                                                                        pixels/seconds))
+
+
+def create_classification_outputs(image, n_classes, class_out_path, prob_out_path=None, out_type="GTiff",
+                                  prob_dtype="float32", update=False):
+    """Creates the class map (and, if prob_out_path is given, the n_classes-band probability raster) matching image.
+    If update is True, outputs that already exist are opened for update instead; they must be the same size as
+    image. Returns (class_dataset, prob_dataset); prob_dataset is None if prob_out_path is not given."""
+    if update and os.path.exists(class_out_path):
+        map_out_image = open_matching_dataset_for_update(image, class_out_path)
+    else:
+        map_out_image = create_matching_dataset(image, class_out_path, format=out_type)
+    prob_out_image = None
+    if prob_out_path and update and os.path.exists(prob_out_path):
+        prob_out_image = open_matching_dataset_for_update(image, prob_out_path)
+    elif prob_out_path:
+        prob_out_image = create_prob_dataset(image, prob_out_path, n_classes, prob_dtype)
+    return map_out_image, prob_out_image
+
+
+def open_matching_dataset_for_update(in_dataset, path):
+    """Opens the raster at path for update, checking that it has the same dimensions as in_dataset"""
+    dataset = gdal.Open(path, gdal.GA_Update)
+    if (dataset.RasterXSize, dataset.RasterYSize) != (in_dataset.RasterXSize, in_dataset.RasterYSize):
+        raise ForestSentinelException("{} is not the same size as the image being classified".format(path))
+    return dataset
+
+
+def get_windows_in_footprint(raster, windows, footprint):
+    """Returns the (x_offset, y_offset, x_size, y_size) windows of raster that intersect the footprint. footprint can
+    be a polygon, or the path to a mask raster on raster's pixel grid, such as the .msk of a new image; then only
+    windows with a nonzero mask pixel are kept, so slivers and scattered patches do not pull in their whole extent."""
+    if not isinstance(footprint, str):
+        return [window for window in windows if get_window_bounds(raster, window).Intersects(footprint)]
+    mask = gdal.Open(footprint)
+    gt = raster.GetGeoTransform()
+    in_footprint = []
+    for window in windows:
+        overlap = get_window_overlap(gt, window, mask)
+        if overlap is not None and read_mask_window(mask, overlap[1]).any():
+            in_footprint.append(window)
+    mask = None
+    return in_footprint
+
+
+def get_window_bounds(raster, window):
+    """Returns a wkbPolygon geometry with the bounding rectangle of an (x_offset, y_offset, x_size, y_size) window
+    of a raster, calculated from its geotransform"""
+    x_off, y_off, x_size, y_size = window
+    gt = raster.GetGeoTransform()
+    x_min = gt[0] + x_off * gt[1]
+    x_max = x_min + x_size * gt[1]
+    y_max = gt[3] + y_off * gt[5]
+    y_min = y_max + y_size * gt[5]  # y resolution is -ve
+    window_bounds = ogr.Geometry(ogr.wkbLinearRing)
+    window_bounds.AddPoint(x_min, y_max)
+    window_bounds.AddPoint(x_max, y_max)
+    window_bounds.AddPoint(x_max, y_min)
+    window_bounds.AddPoint(x_min, y_min)
+    window_bounds.AddPoint(x_min, y_max)
+    bounds_poly = ogr.Geometry(ogr.wkbPolygon)
+    bounds_poly.AddGeometry(window_bounds)
+    return bounds_poly
+
+
+def get_valid_data_footprint(raster_path):
+    """Returns a wkbPolygon geometry with the bounding rectangle of the nonzero pixels in the first band of a raster,
+    such as a .msk or a newly acquired image, or None if every pixel is 0. The raster is read one block row at a
+    time. The rectangle of a sliver or of scattered patches covers much more than their data, so classify_image is
+    better given the raster's path as its footprint."""
+    raster = gdal.Open(raster_path)
+    band = raster.GetRasterBand(1)
+    valid_rows = np.zeros(raster.RasterYSize, dtype=bool)
+    valid_cols = np.zeros(raster.RasterXSize, dtype=bool)
+    block_y = band.GetBlockSize()[1]
+    for y_off in range(0, raster.RasterYSize, block_y):
+        y_size = min(block_y, raster.RasterYSize - y_off)
+        strip = band.ReadAsArray(0, y_off, raster.RasterXSize, y_size) != 0
+        valid_rows[y_off: y_off + y_size] = strip.any(axis=1)
+        valid_cols |= strip.any(axis=0)
+    if not valid_rows.any():
+        return None
+    rows = np.flatnonzero(valid_rows)
+    cols = np.flatnonzero(valid_cols)
+    window = (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+    return get_window_bounds(raster, window)
+
+
+def create_prob_dataset(image, prob_out_path, n_classes, prob_dtype="float32"):
+    """Creates an n_classes-band probability raster matching image, stored as prob_dtype. For integer types,
+    every band's scale is set so that GDAL reads the stored values back as probabilities between 0 and 1."""
+    datatype, scale = get_prob_type_and_scale(prob_dtype)
+    prob_out_image = create_matching_dataset(image, prob_out_path, bands=n_classes, datatype=datatype)
+    if scale != 1:
+        for band_index in range(n_classes):
+            band = prob_out_image.GetRasterBand(band_index + 1)
+            band.SetScale(scale)
+            band.SetOffset(0)
+            band = None
+    return prob_out_image
+
+
+def get_prob_type_and_scale(prob_dtype):
+    """Returns the gdal datatype and the scale (probability per stored unit) used to store probabilities as
+    prob_dtype, which can be "float32", "uint16" or "uint8"."""
+    if prob_dtype == "float32":
+        return gdal.GDT_Float32, 1
+    elif prob_dtype == "uint16":
+        return gdal.GDT_UInt16, 1/65535
+    elif prob_dtype == "uint8":
+        return gdal.GDT_Byte, 1/255
+    else:
+        raise ForestSentinelException("Invalid prob_dtype; can be 'float32', 'uint16' or 'uint8'")
+
+
+def quantize_probs(probs, prob_dtype="float32"):
+    """Converts an array of probabilities between 0 and 1 to prob_dtype. Integer types are rounded to the nearest
+    step of the scale given by get_prob_type_and_scale, so uint8 probabilities are within 0.002 of the originals
+    and uint16 ones within 0.00001."""
+    datatype, scale = get_prob_type_and_scale(prob_dtype)
+    if scale == 1:
+        return np.asarray(probs, dtype=np.float32)
+    return np.rint(np.asarray(probs) / scale).astype(prob_dtype)
+
+
+def classify_window(model, image, window, mask=None, get_probs=False,
+                    nodata_class=0, nodata_prob=0, in_nodata=(0, -9999), prob_dtype="float32"):
+    """Classifies the (x_offset, y_offset, x_size, y_size) window of an open image. Returns a tuple of the classes
+    as a [y, x] array and, if get_probs is True, the probabilities as a [class, y, x] array (otherwise None).
+    Only valid pixels are classified (see get_valid_pixels), with each image in the stack having the model's
+    bands_per_image bands; the rest are nodata_class and nodata_prob."""
+    x_off, y_off, x_size, y_size = window
+    features = read_window_for_ml(image, window)
+    mask_values = None
+    if mask is not None:
+        mask_values = mask.GetRasterBand(1).ReadAsArray(x_off, y_off, x_size, y_size).ravel()
+    valid = get_valid_pixels(features, mask_values, in_nodata, getattr(model, "pyeo_bands_per_image", 4))
+    classes, probs = classify_valid_pixels(model, features, valid, get_probs, nodata_class, nodata_prob, prob_dtype)
+    classes = reshape_ml_out_to_raster(classes, x_size, y_size)
+    if get_probs:
+        probs = reshape_prob_out_to_raster(probs, x_size, y_size)
+    return classes, probs
+
+
+def read_window_for_ml(image, window, dtype=np.float32):
+    """Reads the (x_offset, y_offset, x_size, y_size) window of an open image straight into scikit order
+    [x*y, band]. GDAL is handed a [band, y, x] view of a preallocated [x*y, band] buffer and writes each pixel's
+    bands next to each other (band-interleaved-by-pixel), so, unlike reshape_raster_for_ml, no transposed copy is
+    made. Reading as float32, the dtype sklearn's trees predict in, means the model does not copy it either."""
+    x_off, y_off, x_size, y_size = window
+    features = np.empty((y_size * x_size, image.RasterCount), dtype=dtype)
+    if image.RasterCount == 1:
+        buffer_view = features.reshape((y_size, x_size))
+    else:
+        buffer_view = features.reshape((y_size, x_size, image.RasterCount)).transpose((2, 0, 1))
+    image.ReadAsArray(x_off, y_off, x_size, y_size, buf_obj=buffer_view)
+    return features
+
+
+def get_virtual_ml_array(image):
+    """Returns the whole of an open image as a virtual memory array in scikit order [x*y, band]. The array is mapped
+    band-interleaved-by-pixel, so it reshapes to [x*y, band] without the transposed copy reshape_raster_for_ml
+    makes."""
+    image_array = image.GetVirtualMemArray(band_sequential=False)
+    return image_array.reshape((image.RasterXSize * image.RasterYSize, image.RasterCount))
+
+
+def get_valid_pixels(features, mask_values=None, in_nodata=(0, -9999), bands_per_image=None):
+    """Returns a boolean [x*y] array that is True for each pixel in an [x*y, band] features array that should be
+    classified. A pixel is invalid if it is 0 in mask_values (an [x*y] multiplicative mask, if given) or if every one
+    of its bands is equal to one of the values in in_nodata. If bands_per_image is given and divides the number of
+    bands, the features are taken as a stack of images, and a pixel is also invalid if every band of any one image
+    is nodata, since the change between an image with data and one without means nothing."""
+    n_samples, n_bands = features.shape
+    if not bands_per_image or n_bands % bands_per_image:
+        bands_per_image = n_bands
+    valid = np.ones(n_samples, dtype=bool)
+    if mask_values is not None:
+        valid &= mask_values.astype(bool)
+    for nodata_value in (in_nodata or ()):
+        for first_band in range(0, n_bands, bands_per_image):
+            image_bands = features[:, first_band: first_band + bands_per_image]
+            valid &= np.logical_not(np.all(image_bands == nodata_value, axis=1))
+    return valid
+
+
+def classify_valid_pixels(model, features, valid, get_probs=False, nodata_class=0, nodata_prob=0,
+                          prob_dtype="float32"):
+    """Gathers the pixels of an [x*y, band] features array that are True in valid into a single batch, classifies
+    them and scatters the results back. If the model was trained with derived features (see add_features), they
+    are computed for this batch only. Returns (classes, probs) as int16 [x*y] and [x*y, class] arrays of
+    prob_dtype (see quantize_probs; probs is None unless get_probs is True); invalid pixels are nodata_class and
+    nodata_prob respectively."""
+    n_samples = features.shape[0]
+    classes = np.full(n_samples, nodata_class, dtype=np.int16)
+    probs = None
+    if get_probs:
+        probs = np.full((n_samples, model.n_classes_), quantize_probs(nodata_prob, prob_dtype), dtype=prob_dtype)
+    if not valid.any():
+        return classes, probs
+    valid_features = features[valid]
+    feature_names = getattr(model, "pyeo_features", None)
+    if feature_names:
+        valid_features = add_features(valid_features, feature_names, getattr(model, "pyeo_bands_per_image", 4))
+    valid_classes, valid_probs = predict_classes_and_probs(model, valid_features, get_probs)
+    classes[valid] = valid_classes
+    if get_probs:
+        probs[valid] = quantize_probs(valid_probs, prob_dtype)
+    return classes, probs
+
+
+def add_features(features, feature_names, bands_per_image=4):
+    """Returns an [x*y, band + derived] float32 array of the bands in an [x*y, band] features array followed by the
+    derived features named in feature_names, in that order; see get_feature_function for the names. Works on any
+    batch of pixels, so can be applied to training data and to each window being classified alike. Assumes each
+    image in turn has bands_per_image bands, starting with blue, green, red and NIR, as made by
+    stack_sentinel_2_bands (with any extra_20m_bands after those four) and stack_old_and_new_images."""
+    features = np.asarray(features, dtype=np.float32)
+    if features.shape[1] % bands_per_image != 0:
+        raise ForestSentinelException("{} bands is not a whole number of {}-band images"
+                                      .format(features.shape[1], bands_per_image))
+    derived = [get_feature_function(name)(features, bands_per_image) for name in feature_names]
+    return np.concatenate([features] + derived, axis=1)
+
+
+def get_feature_function(feature_name):
+    """Returns the function that computes a derived feature from an [x*y, band] features array. Feature names are
+    'ndvi', 'ndwi' (one band per image) and 'band_diff' (the new image's bands minus the old image's). Callables
+    are returned as they are."""
+    if callable(feature_name):
+        return feature_name
+    if feature_name == "ndvi":
+        return get_ndvi
+    elif feature_name == "ndwi":
+        return get_ndwi
+    elif feature_name == "band_diff":
+        return get_band_differences
+    else:
+        raise ForestSentinelException("Unknown feature {}; use ndvi, ndwi or band_diff".format(feature_name))
+
+
+def get_ndvi(features, bands_per_image=4):
+    """Returns an [x*y, image] array of the NDVI of each image in an [x*y, band] features array"""
+    return get_normalised_difference(features, 3, 2, bands_per_image)
+
+
+def get_ndwi(features, bands_per_image=4):
+    """Returns an [x*y, image] array of the NDWI (McFeeters) of each image in an [x*y, band] features array"""
+    return get_normalised_difference(features, 1, 3, bands_per_image)
+
+
+def get_normalised_difference(features, band_a, band_b, bands_per_image=4):
+    """Returns (a-b)/(a+b) for bands a and b of each image in an [x*y, band] features array. Pixels where a+b is 0
+    are 0."""
+    a = features[:, band_a::bands_per_image]
+    b = features[:, band_b::bands_per_image]
+    total = a + b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.where(total != 0, (a - b) / total, 0)
+    return out.astype(np.float32)
+
+
+def get_band_differences(features, bands_per_image=4):
+    """Returns the second half of the bands in an [x*y, band] features array minus the first half; for a stack
+    from stack_old_and_new_images, this is the change in each band between the old and new images."""
+    n_bands = features.shape[1]
+    if n_bands % (bands_per_image*2) != 0:
+        raise ForestSentinelException("band_diff needs a stack of two images, but got {} bands".format(n_bands))
+    return features[:, n_bands//2:] - features[:, :n_bands//2]
+
+
+def get_block_windows(raster):
+    """Returns a list of (x_offset, y_offset, x_size, y_size) windows covering the raster, one per native block of
+    its first band. Windows on the right and bottom edges are trimmed to fit inside the raster."""
+    block_x, block_y = raster.GetRasterBand(1).GetBlockSize()
+    windows = []
+    for y_off in range(0, raster.RasterYSize, block_y):
+        y_size = min(block_y, raster.RasterYSize - y_off)
+        for x_off in range(0, raster.RasterXSize, block_x):
+            x_size = min(block_x, raster.RasterXSize - x_off)
+            windows.append((x_off, y_off, x_size, y_size))
+    return windows
+
+
+def write_window(dataset, array, x_off, y_off):
+    """Writes a [y, x] or [band, y, x] array into dataset with its top-left corner at pixel (x_off, y_off)"""
+    if len(array.shape) == 2:
+        array = np.expand_dims(array, 0)
+    for band_index in range(array.shape[0]):
+        dataset.GetRasterBand(band_index + 1).WriteArray(array[band_index, ...], x_off, y_off)
+
+
+def predict_classes_and_probs(model, features, get_probs=False):
+    """Returns (classes, probabilities) for an [x*y, band] array of features; probabilities is None unless get_probs
+    is True. When probabilities are wanted, predict_proba is run once and the classes are taken from its argmax over
+    model.classes_ rather than walking every tree again with predict; this is exactly how sklearn's forests
+    implement predict."""
+    if not get_probs:
+        return model.predict(features), None
+    probs = model.predict_proba(features)
+    classes = model.classes_.take(np.argmax(probs, axis=1), axis=0)
+    return classes, probs
+
+
 def autochunk(dataset, mem_limit=None):
     """Calculates the number of chunks to break a dataset into without a memory error.
     We want to break the dataset into as few chunks as possible without going over mem_limit.
-    mem_limit defaults to total amount of RAM available on machine if not specified"""
-    pixels = dataset.RasterXSize * dataset.RasterYSize
-    bytes_per_pixel = dataset.GetVirtualMemArray().dtype.itemsize*dataset.RasterCount
-    image_bytes = bytes_per_pixel*pixels
+    mem_limit defaults to 80% of the RAM available on machine if not specified. See plan_windows."""
+    return len(plan_windows(dataset, mem_limit))
+
+
+def plan_windows(raster, mem_limit=None, n_classes=0, min_windows=1, bytes_per_pixel=None):
+    """Splits raster into as few (x_offset, y_offset, x_size, y_size) windows as possible such that classifying any
+    one of them takes no more than mem_limit bytes (see get_classification_bytes_per_pixel; n_classes is the number
+    of probability bands being produced, if any). Windows are aligned to the native block size of the raster's first
+    band and are ragged on the right and bottom edges. Where a full-width strip of blocks fits in the budget, windows
+    are full-width strips of whole block rows; otherwise they are runs of blocks along a single block row. If not
+    even one block fits, windows are parts of a block, which costs more reads but keeps to mem_limit.
+    If min_windows is given, windows are made small enough that there are at least that many where possible.
+    bytes_per_pixel overrides the classification estimate, for planning other work in windows.
+    mem_limit defaults to 80% of the RAM available on the machine if not specified."""
     if not mem_limit:
-        mem_limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
-        # Lets assume that 20% of memory is being used for non-map bits
-        mem_limit = int(mem_limit*0.8)
-    # if I went back now, I would fail basic programming here.
-    for num_chunks in range(1, pixels):
-        if pixels % num_chunks != 0:
-            continue
-        chunk_size_bytes = (pixels/num_chunks)*bytes_per_pixel
-        if chunk_size_bytes < mem_limit:
-            return num_chunks
+        mem_limit = get_available_memory()
+    block_x, block_y = raster.GetRasterBand(1).GetBlockSize()
+    width, height = raster.RasterXSize, raster.RasterYSize
+    if bytes_per_pixel is None:
+        bytes_per_pixel = get_classification_bytes_per_pixel(raster, n_classes)
+    budget_pixels = max(1, int(mem_limit // bytes_per_pixel))
+    window_pixels = min(budget_pixels, int(np.ceil(width*height/min_windows)))
+    block_row_pixels = width * block_y
+    if window_pixels >= block_row_pixels:
+        window_width = width
+        window_height = (window_pixels // block_row_pixels) * block_y
+    elif budget_pixels >= block_x * block_y:
+        # min_windows never splits blocks; only a lack of memory does
+        window_width = max(1, window_pixels // (block_x * block_y)) * block_x
+        window_height = block_y
+    else:
+        # Not even one block fits, so split blocks into runs of whole block-width rows, or parts of one row
+        window_width = min(block_x, width, window_pixels)
+        window_height = min(block_y, window_pixels // window_width)
+    windows = []
+    for y_off in range(0, height, window_height):
+        y_size = min(window_height, height - y_off)
+        for x_off in range(0, width, window_width):
+            x_size = min(window_width, width - x_off)
+            windows.append((x_off, y_off, x_size, y_size))
+    return windows
+
+
+def get_classification_bytes_per_pixel(raster, n_classes=0):
+    """Estimates how many bytes of memory classifying a single pixel of raster takes: its float32 feature vector as
+    read by read_window_for_ml and the batch of valid pixels gathered from it, the predicted and int16 classes and,
+    if n_classes is given, the float64 output of predict_proba plus the float32 copy it is scattered into."""
+    feature_bytes = raster.RasterCount * 4 * 2
+    class_bytes = 8 + 2
+    prob_bytes = n_classes * (8 + 4)
+    return feature_bytes + class_bytes + prob_bytes
+
+
+def get_available_memory():
+    """Returns 80% of the physical memory currently available on this machine, in bytes; we assume the other 20% is
+    being used for non-map bits"""
+    mem_limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    return int(mem_limit*0.8)
 
 
 def covert_image_format(image, format):
@@ -1231,18 +2830,37 @@ def covert_image_format(image, format):
 
 
 def classify_directory(in_dir, model_path, class_out_dir, prob_out_dir,
-                       apply_mask=False, out_type="GTiff", num_chunks=None):
+                       apply_mask=False, out_type="GTiff", num_chunks=None, mem_limit=None, n_jobs=1,
+                       prob_dtype="float32"):
     """Classifies every .tif in in_dir using model at model_path. Outputs are saved
-     in class_out_dir and prob_out_dir, named [input_name]_class and _prob, respectively."""
-    # Needs test
+     in class_out_dir and prob_out_dir, named [input_name]_class and _prob, respectively.
+     The model is loaded once for the whole directory. Unless num_chunks is given, each image is classified in
+     windows planned to fit in mem_limit; see classify_image. If n_jobs is anything other than 1, every image is
+     classified on one pool of n_jobs processes; see classify_images_parallel. Probabilities are stored as
+     prob_dtype; see classify_image.
+     Returns a list of (class_out_path, prob_out_path) tuples."""
     log = logging.getLogger(__name__)
     log.info("Classifying directory {}, output saved in {} and {}".format(in_dir, class_out_dir, prob_out_dir))
-    for image_path in glob.glob(in_dir+r"/*.tif"):
+    image_paths = sorted(glob.glob(in_dir+r"/*.tif"))
+    class_out_paths = []
+    prob_out_paths = []
+    for image_path in image_paths:
         image_name = os.path.basename(image_path).split('.')[0]
-        class_out_path = os.path.join(class_out_dir, image_name+"_class.tif")
-        prob_out_path = os.path.join(prob_out_dir, image_name+"_prob.tif")
-        classify_image(image_path, model_path, class_out_path, prob_out_path,
-                       apply_mask, out_type, num_chunks)
+        class_out_paths.append(os.path.join(class_out_dir, image_name+"_class.tif"))
+        prob_out_paths.append(os.path.join(prob_out_dir, image_name+"_prob.tif"))
+    if n_jobs != 1 and num_chunks is None:
+        classify_images_parallel(image_paths, model_path, class_out_paths, prob_out_paths, apply_mask, out_type,
+                                 n_jobs, mem_limit, prob_dtype=prob_dtype)
+    else:
+        model = load_model(model_path)
+        for image_path, class_out_path, prob_out_path in zip(image_paths, class_out_paths, prob_out_paths):
+            start_time = dt.datetime.now()
+            classify_image(image_path, model, class_out_path, prob_out_path,
+                           apply_mask, out_type, num_chunks, mem_limit=mem_limit, prob_dtype=prob_dtype)
+            image = gdal.Open(image_path)
+            log_classification_throughput(image_path, image.RasterXSize * image.RasterYSize, start_time)
+            image = None
+    return list(zip(class_out_paths, prob_out_paths))
 
 
 def reshape_raster_for_ml(image_array):
@@ -1268,11 +2886,15 @@ def reshape_prob_out_to_raster(probs, width, height):
     return image_array
 
 
-def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attribute="CODE"):
+def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attribute="CODE", feature_names=None,
+                         bands_per_image=4):
     """Returns a trained random forest model from the training data. This
     assumes that image and model are in the same directory, with a shapefile.
     Give training_image_path a path to a list of .tif files. See spec in the R drive for data structure.
-    At present, the model is an ExtraTreesClassifier arrived at by tpot; see tpot_classifier_kenya -> tpot 1)"""
+    At present, the model is an ExtraTreesClassifier arrived at by tpot; see tpot_classifier_kenya -> tpot 1)
+    If feature_names is given, the model is trained on those derived features as well (see add_features) and
+    remembers them and bands_per_image, so classify_image computes the same features when it is used. Set
+    bands_per_image for stacks with more than the four 10m bands per image (see stack_sentinel_2_bands)."""
     # This could be optimised by pre-allocating the training array. but not now.
     learning_data = None
     classes = None
@@ -1280,7 +2902,9 @@ def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attri
         training_image_folder, training_image_name = os.path.split(training_image_file_path)
         training_image_name = training_image_name[:-4]  # Strip the file extension
         shape_path = os.path.join(training_image_folder, training_image_name, training_image_name + '.shp')
-        this_training_data, this_classes = get_training_data(training_image_file_path, shape_path, attribute)
+        this_training_data, this_classes = get_training_data(training_image_file_path, shape_path, attribute,
+                                                             feature_names=feature_names,
+                                                             bands_per_image=bands_per_image)
         if learning_data is None:
             learning_data = this_training_data
             classes = this_classes
@@ -1290,31 +2914,142 @@ def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attri
     model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
                                      min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
     model.fit(learning_data, classes)
+    model.pyeo_features = feature_names
+    model.pyeo_bands_per_image = bands_per_image
     scores = cross_val_score(model, learning_data, classes, cv=cross_val_repeats)
     return model, scores
 
 
-def create_model_for_region(path_to_region, model_out, scores_out, attribute="CODE"):
+class CompiledForest:
+    """A flattened, inference-only copy of a fitted sklearn forest classifier (such as the ExtraTreesClassifier made
+    by create_trained_model), for classifying on many processes when memory is short. Every tree's nodes are packed
+    into one set of contiguous NumPy arrays, about a third of the size of the sklearn trees, which joblib can
+    memory-map so that every classify_images_parallel worker shares one copy (see compile_model). Prediction is about
+    three times slower per core than sklearn's, so only use it when the workers' copies of the forest do not fit.
+    Has the predict, predict_proba, classes_ and n_classes_ of the original model, so can be used anywhere that
+    classify_image expects a model."""
+
+    def __init__(self, model, batch_size=2**16):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        node_counts = np.array([tree.node_count for tree in trees])
+        self.offsets = np.concatenate(([0], np.cumsum(node_counts)))
+        self.depths = np.array([tree.max_depth for tree in trees])
+        children = []
+        features = []
+        thresholds = []
+        values = []
+        for tree in trees:
+            is_leaf = tree.children_left == -1
+            node_index = np.arange(tree.node_count)
+            # Children are stored as [left, right] pairs so that a node's next node is children[2*node + go_right];
+            # leaves point back to themselves, so every pixel can take max_depth steps
+            children.append(np.stack((np.where(is_leaf, node_index, tree.children_left),
+                                      np.where(is_leaf, node_index, tree.children_right)), axis=1).ravel())
+            features.append(np.where(is_leaf, 0, tree.feature))
+            # Rounding thresholds down to float32 keeps every split exactly as in the original model
+            threshold = tree.threshold.astype(np.float32)
+            rounded_up = threshold.astype(np.float64) > tree.threshold
+            threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+            threshold[is_leaf] = np.inf
+            thresholds.append(threshold)
+            value = tree.value[:, 0, :]
+            normalizer = value.sum(axis=1, keepdims=True)
+            normalizer[normalizer == 0] = 1
+            values.append(value / normalizer)
+        # Child pointers are relative to each tree's first node; see tree_arrays
+        self.children = np.concatenate(children).astype(np.int32)
+        self.feature = np.concatenate(features).astype(np.int32)
+        self.threshold = np.concatenate(thresholds)
+        self.value = np.concatenate(values).astype(np.float32)
+        self.classes_ = model.classes_
+        self.n_classes_ = model.n_classes_
+        self.pyeo_features = getattr(model, "pyeo_features", None)
+        self.pyeo_bands_per_image = getattr(model, "pyeo_bands_per_image", 4)
+        self.n_trees = len(trees)
+        self.batch_size = batch_size
+        # Prediction is single-threaded; n_jobs is only here so that it can be set like a sklearn model's
+        self.n_jobs = 1
+
+    def tree_arrays(self, tree_index):
+        """Returns views of (children, feature, threshold, value) for one tree"""
+        start, end = self.offsets[tree_index], self.offsets[tree_index + 1]
+        return (self.children[start*2: end*2], self.feature[start: end], self.threshold[start: end],
+                self.value[start: end])
+
+    def predict_proba(self, features):
+        """Returns the mean of the leaf class probabilities of every tree for an [x*y, band] features array"""
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        probs = np.empty((features.shape[0], self.n_classes_), dtype=np.float32)
+        for batch_start in range(0, features.shape[0], self.batch_size):
+            batch = features[batch_start: batch_start + self.batch_size]
+            probs[batch_start: batch_start + batch.shape[0]] = self.sum_tree_probs(batch) / self.n_trees
+        return probs
+
+    def sum_tree_probs(self, features):
+        """Returns the sum over every tree of the leaf probabilities for each pixel in features, walking each tree for
+        the whole batch at once, one level per step"""
+        n_samples, n_features = features.shape
+        flat_features = features.ravel()
+        row_starts = np.arange(n_samples, dtype=np.int32) * n_features
+        probs = np.zeros((n_samples, self.n_classes_), dtype=np.float32)
+        for tree_index in range(self.n_trees):
+            children, feature, threshold, value = self.tree_arrays(tree_index)
+            node = np.zeros(n_samples, dtype=np.int32)
+            for _ in range(self.depths[tree_index]):
+                go_right = flat_features[row_starts + feature[node]] > threshold[node]
+                node = children[2*node + go_right]
+            probs += value[node]
+        return probs
+
+    def predict(self, features):
+        """Returns the most probable class for each pixel in an [x*y, band] features array"""
+        return self.classes_.take(np.argmax(self.predict_proba(features), axis=1), axis=0)
+
+
+def compile_model(model_path, compiled_model_out):
+    """Loads the pickled forest at model_path, flattens it into a CompiledForest and saves that, uncompressed, at
+    compiled_model_out. Giving compiled_model_out to classify_images_parallel (or classify_directory with n_jobs)
+    in place of model_path makes its workers share one memory-mapped copy of the forest."""
+    log = logging.getLogger(__name__)
+    model = load_model(model_path)
+    compiled_model = CompiledForest(model)
+    log.info("Compiled {} trees with {} nodes from {}".format(compiled_model.n_trees, compiled_model.feature.size,
+                                                             model_path))
+    joblib.dump(compiled_model, compiled_model_out)
+    return compiled_model_out
+
+
+def create_model_for_region(path_to_region, model_out, scores_out, attribute="CODE", feature_names=None,
+                            bands_per_image=4):
     """Creates a model based on training data for files in a given region"""
     image_glob = os.path.join(path_to_region, r"*.tif")
     image_list = glob.glob(image_glob)
-    model, scores = create_trained_model(image_list, attribute=attribute)
+    model, scores = create_trained_model(image_list, attribute=attribute, feature_names=feature_names,
+                                         bands_per_image=bands_per_image)
     joblib.dump(model, model_out)
     with open(scores_out, 'w') as score_file:
         score_file.write(str(scores))
 
 
-def create_model_from_signatures(sig_csv_path, model_out):
+def create_model_from_signatures(sig_csv_path, model_out, feature_names=None, bands_per_image=4):
     model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
                                      min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
     data = np.loadtxt(sig_csv_path, delimiter=",").T
-    model.fit(data[1:, :].T, data[0, :])
+    signatures = data[1:, :].T
+    if feature_names:
+        signatures = add_features(signatures, feature_names, bands_per_image)
+    model.fit(signatures, data[0, :])
+    model.pyeo_features = feature_names
+    model.pyeo_bands_per_image = bands_per_image
     joblib.dump(model, model_out)
 
 
-def get_training_data(image_path, shape_path, attribute="CODE", shape_projection_id=4326):
+def get_training_data(image_path, shape_path, attribute="CODE", shape_projection_id=4326, feature_names=None,
+                      bands_per_image=4):
     """Given an image and a shapefile with categories, return x and y suitable
-    for feeding into random_forest.fit.
+    for feeding into random_forest.fit. If feature_names is given, the derived features are appended to x with
+    add_features, exactly as they are when classifying; bands_per_image is the number of bands of each image in
+    the stack.
     Note: THIS WILL FAIL IF YOU HAVE ANY CLASSES NUMBERED '0'
     WRITE A TEST FOR THIS TOO; if this goes wrong, it'll go wrong quietly and in a way that'll cause the most issues
      further on down the line."""
@@ -1349,6 +3084,8 @@ def get_training_data(image_path, shape_path, attribute="CODE", shape_projection
                     ]
         for index in range(len(features)):
             training_data[index, :] = image_view[:, y[index], x[index]]
+        if feature_names:
+            training_data = add_features(training_data, feature_names, bands_per_image)
         return training_data, features
 
 
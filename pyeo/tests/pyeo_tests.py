@@ -18,6 +18,39 @@ def test_stack_images(managed_multiple_geotiff_dir):
     assert result.ReadAsArray()[1,0,4] == 13
 
 
+def test_stack_images_virtual(managed_multiple_geotiff_dir):
+    test_dir = managed_multiple_geotiff_dir
+    images = [os.path.join(test_dir.path, image) for image in os.listdir(test_dir.path)]
+    images.sort()
+    result_path = os.path.join(test_dir.path, "test_out.vrt")
+    pyeo.stack_images_virtual(images, result_path)
+    result = gdal.Open(result_path)
+    assert result.ReadAsArray().shape[0] == 4
+    assert result.ReadAsArray()[0,0,4] == 3
+    assert result.ReadAsArray()[1,0,4] == 13
+
+
+def test_stack_images_mixed_resolution():
+    with TemporaryDirectory() as td:
+        driver = gdal.GetDriverByName("GTiff")
+        fine_path = os.path.join(td, "fine.tif")
+        coarse_path = os.path.join(td, "coarse.tif")
+        fine = driver.Create(fine_path, 4, 4, 1, gdal.GDT_UInt16)
+        fine.SetGeoTransform((0, 10, 0, 40, 0, -10))
+        fine.GetRasterBand(1).WriteArray(np.arange(16).reshape((4, 4)))
+        coarse = driver.Create(coarse_path, 2, 2, 1, gdal.GDT_UInt16)
+        coarse.SetGeoTransform((0, 20, 0, 40, 0, -20))
+        coarse.GetRasterBand(1).WriteArray(np.array([[1, 2], [3, 4]]))
+        fine = None
+        coarse = None
+        result_path = os.path.join(td, "stack.tif")
+        pyeo.stack_images([fine_path, coarse_path], result_path)
+        result = gdal.Open(result_path).ReadAsArray()
+        assert result.shape == (2, 4, 4)
+        assert np.all(result[0] == np.arange(16).reshape((4, 4)))
+        assert np.all(result[1] == np.repeat(np.repeat([[1, 2], [3, 4]], 2, axis=0), 2, axis=1))
+
+
 def test_stack_and_trim_images(managed_noncontiguous_geotiff_dir):
     # Test data is two five band 11x12 pixel geotiffs and a 10x10 polygon
     # The geotiffs upper left corners ar at 90,90 and 100,100
@@ -188,5 +221,528 @@ def test_sort_by_timestamp():
         assert out_paths == target
 
 
+def test_get_block_windows(managed_ml_geotiff_dir):
+    test_dir = managed_ml_geotiff_dir
+    test_image = gdal.Open(os.path.join(test_dir.path, "training_image"))
+    windows = pyeo.get_block_windows(test_image)
+    assert sum(x_size*y_size for _, _, x_size, y_size in windows) == 120
+    assert windows[0][:2] == (0, 0)
+
+
+def test_plan_windows(managed_ml_geotiff_dir):
+    test_dir = managed_ml_geotiff_dir
+    test_image = gdal.Open(os.path.join(test_dir.path, "training_image"))
+    windows = pyeo.plan_windows(test_image, mem_limit=1000, n_classes=3)
+    assert sum(x_size*y_size for _, _, x_size, y_size in windows) == 120
+    assert len(pyeo.plan_windows(test_image, mem_limit=10**9)) == 1
+    windows = pyeo.plan_windows(test_image, mem_limit=5, bytes_per_pixel=1)
+    assert max(x_size*y_size for _, _, x_size, y_size in windows) <= 5
+    assert sum(x_size*y_size for _, _, x_size, y_size in windows) == 120
+
+
+def test_predict_classes_and_probs():
+    import sklearn.ensemble as ens
+    features = np.arange(80).reshape((20, 4))
+    labels = np.array([1, 2, 3, 4]*5)
+    model = ens.ExtraTreesClassifier(n_estimators=10).fit(features, labels)
+    classes, probs = pyeo.predict_classes_and_probs(model, features, get_probs=True)
+    assert np.all(classes == model.predict(features))
+    assert probs.shape == (20, 4)
+    classes, probs = pyeo.predict_classes_and_probs(model, features)
+    assert probs is None
+
+
+def write_random_image(path, seed, options=()):
+    image = gdal.GetDriverByName("GTiff").Create(path, 30, 20, 4, gdal.GDT_Int16, options=list(options))
+    image.SetGeoTransform((0, 10, 0, 200, 0, -10))
+    pixels = np.random.RandomState(seed).randint(1, 100, (4, 20, 30))
+    for band_index, band in enumerate(pixels):
+        image.GetRasterBand(band_index + 1).WriteArray(band)
+    image = None
+    return path
+
+
+def write_random_model(path):
+    import sklearn.ensemble as ens
+    import joblib
+    features = np.random.RandomState(0).randint(1, 100, (200, 4))
+    labels = (features[:, 0] > features[:, 1]).astype(int) + 1
+    joblib.dump(ens.ExtraTreesClassifier(n_estimators=10, random_state=0).fit(features, labels), path)
+    return path
+
+
+def test_classify_image_windowed():
+    with TemporaryDirectory() as td:
+        # 16x16 tiles leave ragged 14 and 4 pixel windows at the right and bottom edges
+        image_path = write_random_image(os.path.join(td, "image.tif"), 1,
+                                        ["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+        model_path = write_random_model(os.path.join(td, "model.pkl"))
+        model = pyeo.load_model(model_path)
+        image = gdal.Open(image_path)
+        features = pyeo.reshape_raster_for_ml(image.ReadAsArray())
+        expected_classes = model.predict(features).reshape((20, 30))
+        expected_probs = np.moveaxis(model.predict_proba(features).reshape((20, 30, 2)), 2, 0)
+        mem_limit = pyeo.get_classification_bytes_per_pixel(image, 2) * 256
+        assert len(pyeo.plan_windows(image, mem_limit, 2)) == 4
+        paths = [os.path.join(td, "class.tif"), os.path.join(td, "prob.tif")]
+        pyeo.classify_image_windowed(image_path, model_path, *paths, mem_limit=mem_limit)
+        assert np.all(gdal.Open(paths[0]).ReadAsArray() == expected_classes)
+        assert np.allclose(gdal.Open(paths[1]).ReadAsArray(), expected_probs, atol=1e-6)
+        chunked_paths = [os.path.join(td, "chunked_class.tif"), os.path.join(td, "chunked_prob.tif")]
+        pyeo.classify_image(image_path, model_path, *chunked_paths, num_chunks=7)
+        assert np.all(gdal.Open(chunked_paths[0]).ReadAsArray() == expected_classes)
+        assert np.allclose(gdal.Open(chunked_paths[1]).ReadAsArray(), expected_probs, atol=1e-6)
+
+
+def test_classify_image_parallel():
+    with TemporaryDirectory() as td:
+        image_path = write_random_image(os.path.join(td, "image.tif"), 1)
+        model_path = write_random_model(os.path.join(td, "model.pkl"))
+        serial_paths = [os.path.join(td, "serial_class.tif"), os.path.join(td, "serial_prob.tif")]
+        parallel_paths = [os.path.join(td, "parallel_class.tif"), os.path.join(td, "parallel_prob.tif")]
+        pyeo.classify_image(image_path, model_path, *serial_paths)
+        pyeo.classify_image_parallel(image_path, model_path, *parallel_paths, n_jobs=2, mem_limit=2000)
+        for serial_path, parallel_path in zip(serial_paths, parallel_paths):
+            assert np.all(gdal.Open(serial_path).ReadAsArray() == gdal.Open(parallel_path).ReadAsArray())
+
+
+def test_classify_images_parallel():
+    with TemporaryDirectory() as td:
+        image_paths = [write_random_image(os.path.join(td, "image_{}.tif".format(seed)), seed) for seed in (1, 2)]
+        model_path = write_random_model(os.path.join(td, "model.pkl"))
+        class_out_paths = [os.path.join(td, "class_{}.tif".format(seed)) for seed in (1, 2)]
+        pyeo.classify_images_parallel(image_paths, model_path, class_out_paths, n_jobs=2, mem_limit=2000)
+        for image_path, class_out_path in zip(image_paths, class_out_paths):
+            serial_path = os.path.join(td, "serial.tif")
+            pyeo.classify_image(image_path, model_path, serial_path)
+            assert np.all(gdal.Open(serial_path).ReadAsArray() == gdal.Open(class_out_path).ReadAsArray())
+
+
+def test_classify_image_mask_footprint():
+    with TemporaryDirectory() as td:
+        image_path = write_random_image(os.path.join(td, "image.tif"), 1,
+                                        ["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+        model_path = write_random_model(os.path.join(td, "model.pkl"))
+        # A diagonal sliver whose bounding rectangle covers every block
+        mask_path = os.path.join(td, "image.msk")
+        mask = gdal.GetDriverByName("GTiff").Create(mask_path, 30, 20, 1, gdal.GDT_Byte)
+        mask.SetGeoTransform((0, 10, 0, 200, 0, -10))
+        sliver = np.zeros((20, 30), dtype=np.uint8)
+        sliver[np.arange(20), np.arange(20) + 10] = 1
+        mask.GetRasterBand(1).WriteArray(sliver)
+        mask = None
+        class_path = os.path.join(td, "class.tif")
+        image = gdal.Open(image_path)
+        mem_limit = pyeo.get_classification_bytes_per_pixel(image, 0) * 256
+        pyeo.classify_image(image_path, model_path, class_path, mem_limit=mem_limit, footprint=mask_path)
+        classes = gdal.Open(class_path).ReadAsArray()
+        windows = pyeo.plan_windows(image, mem_limit)
+        assert len(windows) == 4
+        for x_off, y_off, x_size, y_size in windows:
+            in_sliver = sliver[y_off: y_off + y_size, x_off: x_off + x_size].any()
+            window_classes = classes[y_off: y_off + y_size, x_off: x_off + x_size]
+            assert np.all(window_classes != 0) if in_sliver else np.all(window_classes == 0)
+
+
+def test_compiled_forest():
+    with TemporaryDirectory() as td:
+        model_path = write_random_model(os.path.join(td, "model.pkl"))
+        compiled_path = pyeo.compile_model(model_path, os.path.join(td, "compiled.pkl"))
+        model = pyeo.load_model(model_path)
+        compiled_model = pyeo.load_model(compiled_path, mmap_mode='r')
+        features = np.random.RandomState(1).randint(1, 100, (500, 4))
+        assert np.allclose(compiled_model.predict_proba(features), model.predict_proba(features), atol=1e-6)
+        assert np.all(compiled_model.classes_ == model.classes_)
+        image_path = write_random_image(os.path.join(td, "image.tif"), 1)
+        serial_path = os.path.join(td, "serial_class.tif")
+        parallel_path = os.path.join(td, "parallel_class.tif")
+        pyeo.classify_image(image_path, model_path, serial_path)
+        pyeo.classify_image_parallel(image_path, compiled_path, parallel_path, n_jobs=2, mem_limit=2000)
+        assert np.all(gdal.Open(serial_path).ReadAsArray() == gdal.Open(parallel_path).ReadAsArray())
+
+
+def test_get_valid_pixels():
+    features = np.ones((6, 3))
+    features[0, :] = 0
+    features[1, :] = -9999
+    features[2, 0] = 0
+    mask_values = np.array([1, 1, 1, 1, 0, 1])
+    valid = pyeo.get_valid_pixels(features, mask_values)
+    assert np.all(valid == [False, False, True, True, False, True])
+    # An old/new stack where only one image has data is invalid
+    stack = np.ones((3, 8))
+    stack[0, :4] = 0
+    stack[1, 4:] = -9999
+    stack[2, :2] = 0
+    assert np.all(pyeo.get_valid_pixels(stack, bands_per_image=4) == [False, False, True])
+    assert np.all(pyeo.get_valid_pixels(stack) == [True, True, True])
+
+
+def test_quantize_probs():
+    probs = np.array([[0, 0.25, 0.75, 1]])
+    assert np.all(pyeo.quantize_probs(probs, "uint8") == [[0, 64, 191, 255]])
+    assert pyeo.quantize_probs(probs, "uint16").dtype == np.uint16
+    assert pyeo.quantize_probs(probs).dtype == np.float32
+
+
+def test_read_window_for_ml(managed_ml_geotiff_dir):
+    test_dir = managed_ml_geotiff_dir
+    test_image = gdal.Open(os.path.join(test_dir.path, "training_image"))
+    target = pyeo.reshape_raster_for_ml(test_image.ReadAsArray())
+    window = (0, 0, test_image.RasterXSize, test_image.RasterYSize)
+    features = pyeo.read_window_for_ml(test_image, window)
+    assert features.shape == (120, 8)
+    assert features.dtype == np.float32
+    assert np.all(features == target)
+
+
+def test_get_window_bounds(managed_noncontiguous_geotiff_dir):
+    test_dir = managed_noncontiguous_geotiff_dir
+    test_raster = gdal.Open(os.path.join(test_dir.path, "ne_test"))
+    result = pyeo.get_window_bounds(test_raster, (0, 0, test_raster.RasterXSize, test_raster.RasterYSize))
+    assert result.GetEnvelope() == pyeo.get_raster_bounds(test_raster).GetEnvelope()
+
+
+def test_add_features():
+    old = [1, 2, 3, 5]
+    new = [2, 4, 6, 2]
+    features = np.array([old + new, [0]*8])
+    result = pyeo.add_features(features, ["ndvi", "ndwi", "band_diff"])
+    assert result.shape == (2, 8 + 2 + 2 + 4)
+    assert np.all(result[:, :8] == features)
+    assert np.allclose(result[0, 8:], [2/8, -4/8, -3/7, 2/6, 1, 2, 3, -3])
+    assert np.all(result[1, 8:] == 0)
+
+
+def test_classify_valid_pixels_bands_per_image():
+    import sklearn.ensemble as ens
+    features = np.random.RandomState(0).randint(1, 100, (50, 12))
+    labels = features[:, 0] > features[:, 3]
+    derived = pyeo.add_features(features, ["ndvi"], bands_per_image=6)
+    model = ens.ExtraTreesClassifier(n_estimators=10, random_state=0).fit(derived, labels)
+    model.pyeo_features = ["ndvi"]
+    model.pyeo_bands_per_image = 6
+    classes, _ = pyeo.classify_valid_pixels(model, features, np.ones(50, dtype=bool))
+    assert np.all(classes == model.predict(derived))
+
+
+def test_get_common_datatype():
+    driver = gdal.GetDriverByName("MEM")
+    s2_image = driver.Create("", 2, 2, 4, gdal.GDT_UInt16)
+    signed_image = driver.Create("", 2, 2, 1, gdal.GDT_Int16)
+    assert pyeo.get_common_datatype([s2_image, s2_image]) == gdal.GDT_UInt16
+    assert pyeo.get_common_datatype([s2_image, signed_image]) == gdal.GDT_Int32
+    pyeo.check_nodata_fits(0, gdal.GDT_UInt16)
+    try:
+        pyeo.check_nodata_fits(-9999, gdal.GDT_UInt16)
+        assert False
+    except pyeo.ForestSentinelException:
+        pass
+
+
+def test_get_creation_options():
+    options = pyeo.get_creation_options("GTiff", gdal.GDT_UInt16)
+    assert "TILED=YES" in options
+    assert "COMPRESS=DEFLATE" in options
+    assert "PREDICTOR=2" in options
+    assert "PREDICTOR=3" in pyeo.get_creation_options("GTiff", gdal.GDT_Float32)
+    assert pyeo.get_creation_options("VRT", gdal.GDT_UInt16) == []
+    pyeo.set_output_profile(compress="NONE")
+    try:
+        assert not any(option.startswith("COMPRESS") for option in pyeo.get_creation_options())
+    finally:
+        pyeo.set_output_profile(compress="DEFLATE")
+
+
+def test_update_overview_windows():
+    with TemporaryDirectory() as td:
+        driver = gdal.GetDriverByName("GTiff")
+        paths = [os.path.join(td, "updated.tif"), os.path.join(td, "rebuilt.tif")]
+        for path in paths:
+            raster = driver.Create(path, 70, 60, 1, gdal.GDT_Byte)
+            raster.GetRasterBand(1).WriteArray(np.random.RandomState(0).randint(0, 100, (60, 70)))
+            raster.BuildOverviews("NEAREST", [2, 4])
+            raster = None
+        window = (10, 20, 25, 15)
+        new_data = np.random.RandomState(1).randint(0, 100, (15, 25))
+        updated = gdal.Open(paths[0], gdal.GA_Update)
+        updated.GetRasterBand(1).WriteArray(new_data, 10, 20)
+        pyeo.update_overview_windows(updated, [window])
+        rebuilt = gdal.Open(paths[1], gdal.GA_Update)
+        rebuilt.GetRasterBand(1).WriteArray(new_data, 10, 20)
+        rebuilt.BuildOverviews("NEAREST", [2, 4])
+        for overview_index in range(2):
+            assert np.all(updated.GetRasterBand(1).GetOverview(overview_index).ReadAsArray() ==
+                          rebuilt.GetRasterBand(1).GetOverview(overview_index).ReadAsArray())
+
+
+def test_get_window_overlap():
+    raster = gdal.GetDriverByName("MEM").Create("", 10, 10, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform((50, 10, 0, -20, 0, -10))  # Top left is pixel (5, 2) of the output
+    out_gt = (0, 10, 0, 0, 0, -10)
+    assert pyeo.get_window_overlap(out_gt, (0, 0, 8, 8), raster) == ((5, 2), (0, 0, 3, 6))
+    assert pyeo.get_window_overlap(out_gt, (8, 8, 16, 16), raster) == ((0, 0), (3, 6, 7, 4))
+    assert pyeo.get_window_overlap(out_gt, (0, 0, 5, 5), raster) is None
+
+
+def test_reduce_time_stack():
+    stack = np.full((3, 4, 1, 2), np.nan, dtype=np.float32)
+    stack[0, :, 0, 0] = [10, 20, 30, 90]   # NDVI 0.5
+    stack[1, :, 0, 0] = [5, 10, 10, 30]    # NDVI 0.5, darkest blue
+    stack[2, :, 0, 0] = [30, 40, 10, 90]   # NDVI 0.8
+    assert np.all(pyeo.reduce_time_stack(stack, np.uint16, "median")[:, 0, 0] == [10, 20, 10, 90])
+    assert np.all(pyeo.reduce_time_stack(stack, np.uint16, "max_ndvi")[:, 0, 0] == [30, 40, 10, 90])
+    assert np.all(pyeo.reduce_time_stack(stack, np.uint16, "best_pixel")[:, 0, 0] == [5, 10, 10, 30])
+    assert np.all(pyeo.reduce_time_stack(stack, np.uint16, "percentile", 100)[:, 0, 0] == [30, 40, 30, 90])
+    assert np.all(pyeo.reduce_time_stack(stack, np.uint16, "median")[:, 0, 1] == 0)
+
+
+def test_grow_composite():
+    with TemporaryDirectory() as td:
+        driver = gdal.GetDriverByName("GTiff")
+        composite_path = os.path.join(td, "composite.tif")
+        image_path = os.path.join(td, "image.tif")
+        for path, x_origin, value in ((composite_path, 0, 5), (pyeo.get_mask_path(composite_path), 0, 1),
+                                      (image_path, 20, 7)):
+            raster = driver.Create(path, 2, 2, 1, gdal.GDT_Byte)
+            raster.SetGeoTransform((x_origin, 10, 0, 20, 0, -10))
+            raster.GetRasterBand(1).Fill(value)
+            raster = None
+        assert pyeo.grow_composite(composite_path, gdal.Open(image_path))
+        assert np.all(gdal.Open(composite_path).ReadAsArray() == [[5, 5, 0, 0], [5, 5, 0, 0]])
+        assert np.all(gdal.Open(pyeo.get_mask_path(composite_path)).ReadAsArray() == [[1, 1, 0, 0], [1, 1, 0, 0]])
+        assert not pyeo.grow_composite(composite_path, gdal.Open(image_path))
+
+
+def write_test_raster(path, array, x_origin=0, y_origin=0, datatype=gdal.GDT_Int16):
+    bands, y_size, x_size = array.shape
+    raster = gdal.GetDriverByName("GTiff").Create(path, x_size, y_size, bands, datatype)
+    raster.SetGeoTransform((x_origin, 10, 0, y_origin, 0, -10))
+    for band_index, band in enumerate(array):
+        raster.GetRasterBand(band_index + 1).WriteArray(band)
+    raster = None
+    return path
+
+
+def write_offset_images_with_masks(td):
+    """Writes two 2-band images, the second 3 pixels right of and 1 pixel below the first, with single-band masks.
+    Returns their paths and the composite they make over the 9x5 union of their extents."""
+    image_paths = [os.path.join(td, "S2_20180101T100000.tif"), os.path.join(td, "S2_20180201T100000.tif")]
+    origins = [(0, 0), (3, 1)]
+    expected = np.zeros((2, 5, 9), dtype=np.int16)
+    for index, (image_path, (x, y)) in enumerate(zip(image_paths, origins)):
+        data = (np.arange(48).reshape((2, 4, 6)) + 1 + 100*index).astype(np.int16)
+        clear = np.ones((1, 4, 6), dtype=np.uint8)
+        clear[0, :, 0] = 0
+        write_test_raster(image_path, data, x*10, -y*10)
+        write_test_raster(pyeo.get_mask_path(image_path), clear, x*10, -y*10, gdal.GDT_Byte)
+        np.copyto(expected[:, y: y + 4, x: x + 6], data, where=clear.astype(bool))
+    return image_paths, expected
+
+
+def test_composite_images_with_mask():
+    with TemporaryDirectory() as td:
+        image_paths, expected = write_offset_images_with_masks(td)
+        serial_path = os.path.join(td, "serial.tif")
+        pool_path = os.path.join(td, "pool.tif")
+        pyeo.composite_images_with_mask(image_paths, serial_path, mem_limit=13*9, provenance=True)
+        pyeo.composite_images_with_mask(image_paths, pool_path, mem_limit=13*9*2, n_jobs=2, provenance=True)
+        composite = gdal.Open(serial_path).ReadAsArray()
+        # The second image wins where both are clear; its masked first column keeps the first image's pixels
+        assert np.all(composite == expected)
+        assert np.all(composite[:, 1, 3] == expected[:, 1, 3]) and composite[0, 1, 3] < 100
+        assert np.all(composite[:, :, 0] == 0)
+        assert np.all(composite[:, 0, 6:] == 0)
+        assert np.all(gdal.Open(pool_path).ReadAsArray() == composite)
+        provenance = gdal.Open(pyeo.get_provenance_path(serial_path)).ReadAsArray()
+        assert provenance[1, 1, 4] == 2 and provenance[1, 0, 4] == 1 and provenance[1, 0, 0] == 0
+        assert np.all(gdal.Open(pyeo.get_provenance_path(pool_path)).ReadAsArray() == provenance)
+
+
+def test_mosaic_images():
+    with TemporaryDirectory() as td:
+        # The later class map starts 2 pixels right of the earlier one; each has a nodata pixel in the overlap
+        paths = [os.path.join(td, "class_20180301T100000.tif"), os.path.join(td, "class_20180101T100000.tif")]
+        prob_paths = [os.path.join(td, "prob_20180301T100000.tif"), os.path.join(td, "prob_20180101T100000.tif")]
+        classes = np.ones((2, 1, 3, 4), dtype=np.uint8)
+        classes[0, 0, 0, 2] = 0
+        classes[1] = 2
+        classes[1, 0, 1, 0] = 0
+        confidences = np.array([[0.9, 0.9, 0.9, 0.6], [0.7, 0.7, 0.7, 0.7]])
+        for index, (path, prob_path) in enumerate(zip(paths, prob_paths)):
+            write_test_raster(path, classes[index], index*20, 0, gdal.GDT_Byte)
+            probs = np.stack([np.tile(confidences[index], (3, 1)), 1 - np.tile(confidences[index], (3, 1))])
+            prob_raster = pyeo.create_prob_dataset(gdal.Open(path), prob_path, 2, "uint8")
+            pyeo.write_window(prob_raster, pyeo.quantize_probs(probs, "uint8"), 0, 0)
+            prob_raster = None
+        expected = {
+            "order": [[1, 1, 2, 2, 2, 2], [1, 1, 1, 2, 2, 2], [1, 1, 2, 2, 2, 2]],
+            "latest": [[1, 1, 2, 1, 2, 2], [1, 1, 1, 1, 2, 2], [1, 1, 1, 1, 2, 2]],
+            "confidence": [[1, 1, 2, 2, 2, 2], [1, 1, 1, 2, 2, 2], [1, 1, 1, 2, 2, 2]]
+        }
+        for priority, expected_mosaic in expected.items():
+            for n_jobs in (1, 2):
+                out_path = os.path.join(td, "mosaic_{}_{}.tif".format(priority, n_jobs))
+                pyeo.mosaic_images(paths, out_path, n_jobs=n_jobs, mem_limit=16*6*n_jobs, priority=priority,
+                                   prob_paths=prob_paths)
+                assert np.all(gdal.Open(out_path).ReadAsArray() == expected_mosaic)
+        # Confidence does not depend on the order the rasters are given in
+        pyeo.mosaic_images(paths[::-1], os.path.join(td, "reversed.tif"), priority="confidence",
+                           prob_paths=prob_paths[::-1])
+        assert np.all(gdal.Open(os.path.join(td, "reversed.tif")).ReadAsArray() == expected["confidence"])
+
+
+def test_update_composite_with_image():
+    with TemporaryDirectory() as td:
+        image_paths, expected = write_offset_images_with_masks(td)
+        # A third image, clear in a single pixel
+        image_paths.append(write_test_raster(os.path.join(td, "S2_20180301T100000.tif"),
+                                             np.full((2, 4, 6), 500, dtype=np.int16)))
+        clear = np.zeros((1, 4, 6), dtype=np.uint8)
+        clear[0, 2, 4] = 1
+        write_test_raster(pyeo.get_mask_path(image_paths[2]), clear, datatype=gdal.GDT_Byte)
+        expected[:, 2, 4] = 500
+        full_path = os.path.join(td, "full.tif")
+        updated_path = os.path.join(td, "updated.tif")
+        pyeo.composite_images_with_mask(image_paths, full_path, provenance=True)
+        pyeo.composite_images_with_mask(image_paths[:1], updated_path, provenance=True)
+        # The second image reaches outside the first, so the composite is grown before it is updated
+        pyeo.update_composite_with_image(updated_path, image_paths[1])
+        pyeo.update_composite_with_image(updated_path, image_paths[2])
+        for get_path in (lambda path: path, pyeo.get_mask_path, pyeo.get_provenance_path):
+            updated = gdal.Open(get_path(updated_path))
+            full = gdal.Open(get_path(full_path))
+            assert updated.GetGeoTransform() == full.GetGeoTransform()
+            assert np.all(updated.ReadAsArray() == full.ReadAsArray())
+        assert np.all(gdal.Open(updated_path).ReadAsArray() == expected)
+        # An image with no clear pixels leaves the composite as it was
+        write_test_raster(pyeo.get_mask_path(image_paths[2]), np.zeros((1, 4, 6)), datatype=gdal.GDT_Byte)
+        pyeo.update_composite_with_image(updated_path, image_paths[2])
+        assert np.all(gdal.Open(updated_path).ReadAsArray() == expected)
+        assert np.all(gdal.Open(pyeo.get_provenance_path(updated_path)).ReadAsArray() ==
+                      gdal.Open(pyeo.get_provenance_path(full_path)).ReadAsArray())
+
+
+def test_get_days_since_epoch():
+    assert pyeo.get_days_since_epoch(pyeo.get_s2_image_acquisition_time("S2_20180301T101010.tif")) == 17591
+    assert pyeo.get_provenance_path("/data/composite_20180301T101010.tif") == "/data/composite_20180301T101010.prov"
+
+
+def test_get_time_stack_provenance():
+    stack = np.full((2, 1, 1, 3), np.nan, dtype=np.float32)
+    stack[0, 0, 0, :2] = [5, 50]
+    stack[1, 0, 0, 1] = 10
+    result = pyeo.get_time_stack_provenance(stack, [100, 200])
+    assert result.dtype == np.uint16
+    assert np.all(result[0, 0] == [100, 200, 0])
+    assert np.all(result[1, 0] == [1, 2, 0])
+
+
+def test_get_rasters_in_windows():
+    driver = gdal.GetDriverByName("MEM")
+    left = driver.Create("", 10, 10, 1, gdal.GDT_Byte)
+    left.SetGeoTransform((0, 10, 0, 0, 0, -10))
+    right = driver.Create("", 10, 10, 1, gdal.GDT_Byte)
+    right.SetGeoTransform((80, 10, 0, 0, 0, -10))
+    windows = [(0, 0, 8, 10), (8, 0, 8, 10), (16, 0, 2, 10)]
+    result = pyeo.get_rasters_in_windows((0, 10, 0, 0, 0, -10), windows, [left, right])
+    assert [list(indices) for indices in result] == [[0], [0, 1], [1]]
+
+
+def test_select_stack_partners():
+    bounds = np.array([
+        [0, 100, 0, 100],   # Newest image
+        [0, 60, 0, 100],
+        [50, 100, 0, 50],
+        [20, 40, 20, 40],   # Already covered
+        [60, 100, 50, 100],
+        [200, 300, 0, 10]   # Does not overlap
+    ])
+    assert pyeo.select_stack_partners(bounds, threshold=100) == [1, 2, 4]
+    assert pyeo.select_stack_partners(bounds, threshold=3000) == [1, 2]
+
+
+def test_select_stack_partners_many_images():
+    # Ten strips cover the newest image, followed by many images that would cover it again
+    strips = [[x, x + 10, 0, 100] for x in range(0, 100, 10)]
+    bounds = np.array([[0, 100, 0, 100]] + strips * 5000)
+    assert pyeo.select_stack_partners(bounds, threshold=1) == list(range(1, 11))
+    assert pyeo.select_stack_partners(bounds[:-1], threshold=0) == list(range(1, 11))
+
+
+def test_upsample_array():
+    array = np.array([[1, 2], [3, 4]])
+    assert np.all(pyeo.upsample_array(array, 2) == [[1, 1, 2, 2], [1, 1, 2, 2], [3, 3, 4, 4], [3, 3, 4, 4]])
+    assert pyeo.upsample_array(array, 2, (5, 3)).shape == (5, 3)
+    assert np.all(pyeo.upsample_array(array, 2, (2, 3), (1, 1)) == [[1, 2, 2], [3, 4, 4]])
+
+
+def test_get_upsampling():
+    with TemporaryDirectory() as td:
+        driver = gdal.GetDriverByName("GTiff")
+        coarse = driver.Create(os.path.join(td, "coarse.tif"), 10, 10, 1, gdal.GDT_Byte)
+        coarse.SetGeoTransform((1000, 20, 0, 2000, 0, -20))
+        fine = driver.Create(os.path.join(td, "fine.tif"), 10, 10, 1, gdal.GDT_Byte)
+        fine.SetGeoTransform((1030, 10, 0, 1980, 0, -10))
+        assert pyeo.get_upsampling(coarse, fine) == (2, (2, 3))
+        for misaligned in [(1035, 10, 0, 1980, 0, -10), (1030, 15, 0, 1980, 0, -15)]:
+            fine.SetGeoTransform(misaligned)
+            try:
+                pyeo.get_upsampling(coarse, fine)
+                assert False
+            except pyeo.ForestSentinelException:
+                pass
+
+
+def test_pack_mask_flags():
+    cloud = np.array([[True, False], [False, False]])
+    shadow = np.array([[True, True], [False, False]])
+    flags = pyeo.pack_mask_flags({"cloud": cloud, "shadow": shadow})
+    assert flags.dtype == np.uint8
+    assert np.all(pyeo.get_clear_from_flags(flags) == [[False, False], [True, True]])
+    assert np.all(pyeo.get_clear_from_flags(flags, ["cloud"]) == [[False, True], [True, True]])
+
+
+def test_create_mask_from_flags():
+    with TemporaryDirectory() as td:
+        image_path = write_random_image(os.path.join(td, "image.tif"), 0)
+        image = gdal.Open(image_path, gdal.GA_Update)
+        for band_index in range(4):
+            image.GetRasterBand(band_index + 1).WriteArray(np.zeros((2, 30)), 0, 0)
+        image = None
+        nodata = pyeo.get_nodata_array(image_path)
+        assert nodata[:2].all() and not nodata[2:].any()
+        cloud = np.zeros((20, 30), dtype=bool)
+        cloud[10:, :5] = True
+        pyeo.write_mask(image_path, ~(cloud | nodata), {"cloud": cloud, "nodata": nodata})
+        pyeo.create_mask_from_flags(image_path, ["nodata"])
+        mask = gdal.Open(pyeo.get_mask_path(image_path)).ReadAsArray().astype(bool)
+        assert np.all(mask == ~nodata)
+
+
+def test_get_scl_lut():
+    lut = pyeo.get_scl_lut()
+    assert lut.shape == (256,)
+    flags = lut[np.array([[4, 3], [9, 11]], dtype=np.uint8)]
+    assert np.all(pyeo.get_clear_from_flags(flags) == [[True, False], [False, False]])
+    assert np.all(pyeo.get_clear_from_flags(flags, ["shadow"]) == [[True, False], [True, True]])
+
+
 def test_combine_masks_or():
-    with Tempor
\ No newline at end of file
+    with TemporaryDirectory() as td:
+        driver = gdal.GetDriverByName("GTiff")
+        mask_paths = [os.path.join(td, "first.msk"), os.path.join(td, "second.msk")]
+        mask_arrays = [np.array([[1, 1, 0], [1, 0, 1]]), np.array([[0, 1, 0], [1, 1, 0]])]
+        for mask_path, mask_array, x_origin in zip(mask_paths, mask_arrays, (0, 10)):
+            mask = driver.Create(mask_path, 3, 2, 1, gdal.GDT_Byte)
+            mask.SetGeoTransform((x_origin, 10, 0, 20, 0, -10))
+            mask.GetRasterBand(1).WriteArray(mask_array)
+            mask = None
+        out_path = os.path.join(td, "combined.msk")
+        pyeo.combine_masks(mask_paths, out_path, combination_func="or", geometry_func="union")
+        assert np.all(gdal.Open(out_path).ReadAsArray() == [[1, 1, 1, 0], [1, 1, 1, 0]])
+        assert gdal.Open(out_path).GetRasterBand(1).GetMetadataItem("NBITS", "IMAGE_STRUCTURE") == "1"
+        pyeo.combine_masks(mask_paths, out_path, combination_func="and", geometry_func="intersect")
+        assert np.all(gdal.Open(out_path).ReadAsArray() == [[0, 0], [0, 1]])
+        pyeo.combine_masks(mask_paths, out_path, combination_func="count", geometry_func="union", threshold=2)
+        assert np.all(gdal.Open(out_path).ReadAsArray() == [[0, 0, 0, 0], [0, 0, 1, 0]])